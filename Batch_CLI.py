@@ -0,0 +1,192 @@
+"""
+#############################################################
+SUMMARY: This script runs the whole pipeline for a batch of
+images without a window, an image viewer or a printer, and
+saves the g-code (see 'GCode_Exporter.py') and a preview
+image for each one. Every image can have its own settings
+from a manifest instead of swapping blocks in and out of
+'Univ_Settings.py', and independent jobs run at the same time
+across the machine's cores, so a whole week of murals can be
+prepared overnight in one go.
+
+USAGE:
+    python Batch_CLI.py image1.jpg image2.png [--units-wide 5 --units-high 5 --white-cap 150]
+                                               [--engine crosshatch]
+    python Batch_CLI.py --manifest week.json [--out batch_output] [--jobs 4] [--per-group]
+
+A manifest is a JSON list (or a CSV file with a header row)
+of jobs with an 'image' and any of 'units_wide', 'units_high',
+'white_cap', 'pixels_of_deadspace', 'hatch_engine' and 'name'.
+Anything left out comes from 'Univ_Settings.py'. Image paths
+are relative to the manifest. Jobs that would share a name
+(e.g. one image at two white_caps) get the settings that set
+them apart added to it, so they don't overwrite each other.
+#############################################################
+"""
+
+from Univ_Settings import *
+
+from Hatch_Cache import cached_hatching_set
+from Unit_Reorderer import reorder_units_into_groups, get_raw_converted_total_lines
+from GCode_Exporter import export_job
+from Print_Simulator import estimate_job, format_estimate
+from Preview_Renderer import render_preview, save_preview
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import traceback
+
+# manifest columns that are numbers
+JOB_NUMBER_SETTINGS = ("units_wide", "units_high", "white_cap", "pixels_of_deadspace")
+
+################### JOBS
+
+def make_job(image, **overrides):
+    """Return a job's settings: the image plus the settings it overrides, the rest from 'Univ_Settings.py'"""
+    job = {
+        "image": image,
+        "units_wide": units_wide,
+        "units_high": units_high,
+        "white_cap": white_cap,
+        "pixels_of_deadspace": pixels_of_deadspace,
+        "hatch_engine": hatch_engine,
+    }
+    for key, value in overrides.items():
+        if value not in (None, ""):
+            job[key] = int(value) if key in JOB_NUMBER_SETTINGS else value
+    job.setdefault("name", os.path.splitext(os.path.basename(image))[0])
+    return job
+
+def read_manifest(path):
+    """Read a JSON or CSV manifest into a list of jobs"""
+    with open(path, newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = json.load(f)
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for row in rows:
+        row = dict(row)
+        image = os.path.join(base_dir, row.pop("image"))
+        jobs.append(make_job(image, **row))
+    return jobs
+
+def run_job(job, out_dir, per_group=False):
+    """Run one image through the pipeline to g-code files and a preview. Returns a summary of the job"""
+    if not os.path.isfile(job["image"]):
+        raise FileNotFoundError(f"No image at {job['image']}")
+
+    job_dir = os.path.join(out_dir, job["name"])
+    os.makedirs(job_dir, exist_ok=True)
+    dimensions = (job["units_wide"], job["units_high"])
+
+    # the stages print progress, which would get jumbled up between jobs
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        # (each job hatches in its own process, so it doesn't start a pool of its own)
+        _, total_lines_set = cached_hatching_set(job["image"], dimensions, job["white_cap"],
+                                                 job["pixels_of_deadspace"], show_image=False, workers=1,
+                                                 engine=job["hatch_engine"])
+
+        preview_path = os.path.join(job_dir, f"{job['name']}_preview.png")
+        save_preview(render_preview(total_lines_set, dimensions, job["pixels_of_deadspace"]), preview_path)
+
+        raw_converted_total_lines = get_raw_converted_total_lines(reorder_units_into_groups(total_lines_set, dimensions))
+        gcode_paths = export_job(raw_converted_total_lines, os.path.join(job_dir, f"{job['name']}.gcode"),
+                                 per_group, job)
+        _, totals = estimate_job(raw_converted_total_lines)
+
+    return {
+        **job,
+        "groups": len(raw_converted_total_lines),
+        "lines": sum(len(group) for group in raw_converted_total_lines),
+        "estimated_seconds": totals["total"],
+        "estimate": format_estimate(totals),
+        "gcode": gcode_paths,
+        "preview": preview_path,
+        "log": log.getvalue().splitlines(),
+    }
+
+def _run_job_safely(job, out_dir, per_group):
+    """Process pool worker: run a job, turning a failure into a summary instead of stopping the batch"""
+    try:
+        return run_job(job, out_dir, per_group)
+    except Exception as e:
+        return {**job, "error": f"{type(e).__name__}: {e}", "traceback": traceback.format_exc()}
+
+def unique_job_names(jobs):
+    """Rename jobs that share a name (every job writes into a folder named after it, so two jobs with
+    one name would overwrite each other) by adding the settings that set them apart, or their place
+    in the batch where that isn't enough. The jobs are changed in place"""
+    names = [job["name"] for job in jobs]
+    for name in set(names):
+        same_name = [job for job in jobs if job["name"] == name]
+        if len(same_name) < 2:
+            continue
+        differing = [key for key in same_name[0] if key not in ("name", "image") and
+                     len({str(job.get(key)) for job in same_name}) > 1]
+        for job in same_name:
+            job["name"] = "_".join([name] + [f"{key}{job[key]}" for key in differing])
+
+    # (same image and settings twice, or a new name that clashes with another job's)
+    taken = set()
+    for i, job in enumerate(jobs):
+        while job["name"] in taken:
+            job["name"] = f"{job['name']}_{i + 1}"
+        taken.add(job["name"])
+    return jobs
+
+def run_batch(jobs, out_dir, num_workers=None, per_group=False):
+    """Run every job, several at once, and save a summary of them all to the output folder"""
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = unique_job_names(list(jobs))
+    summaries = [None] * len(jobs)
+
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        futures = {pool.submit(_run_job_safely, job, out_dir, per_group): i for i, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            # (kept in the order the jobs were given)
+            summary = summaries[futures[future]] = future.result()
+            if "error" in summary:
+                print(f"FAILED {summary['name']}: {summary['error']}")
+            else:
+                print(f"Done   {summary['name']}: {summary['groups']} unit groups, {summary['lines']} lines, "
+                      f"{summary['estimate']}")
+
+    with open(os.path.join(out_dir, "batch_summary.json"), "w") as f:
+        json.dump(summaries, f, indent=2)
+
+    num_failed = sum("error" in summary for summary in summaries)
+    print(f"Finished {len(summaries) - num_failed} of {len(summaries)} jobs, output in {out_dir}")
+    return summaries
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Prepare g-code and previews for a batch of images")
+    parser.add_argument("images", nargs="*", help="images to run with the settings below")
+    parser.add_argument("--manifest", help="JSON or CSV file of jobs with their own settings")
+    parser.add_argument("--units-wide", type=int)
+    parser.add_argument("--units-high", type=int)
+    parser.add_argument("--white-cap", type=int)
+    parser.add_argument("--deadspace", type=int, dest="pixels_of_deadspace")
+    parser.add_argument("--engine", dest="hatch_engine", help="hatching engine (e.g. 'numpy' or 'crosshatch')")
+    parser.add_argument("--out", default="batch_output", help="folder for the g-code and previews")
+    parser.add_argument("--jobs", type=int, default=None, help="jobs run at once (default: one per core)")
+    parser.add_argument("--per-group", action="store_true", help="write one g-code file per unit group")
+    args = parser.parse_args()
+
+    overrides = {"units_wide": args.units_wide, "units_high": args.units_high,
+                 "white_cap": args.white_cap, "pixels_of_deadspace": args.pixels_of_deadspace,
+                 "hatch_engine": args.hatch_engine}
+    batch_jobs = [make_job(image, **overrides) for image in args.images]
+    if args.manifest:
+        batch_jobs += read_manifest(args.manifest)
+    if not batch_jobs:
+        parser.error("give some images or a --manifest")
+
+    run_batch(batch_jobs, args.out, args.jobs, args.per_group)
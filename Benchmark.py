@@ -0,0 +1,181 @@
+"""
+#############################################################
+SUMMARY: This script times every stage of the pipeline on
+made-up images (solid black/white, gradients, checkerboards,
+noise and a photo-like image) for grids of 1x1 up to 20x20
+units, and saves the timings as JSON so runs can be compared.
+It never opens an image viewer, a pygame window or a serial
+port, so it can run on any machine.
+
+USAGE:
+    python Benchmark.py [--grids 1x1,5x5] [--images noise,photo] [--repeat 3]
+                        [--out bench.json] [--compare old_bench.json]
+#############################################################
+"""
+
+from Univ_Settings import *
+
+from Image_Generator import load_image, resize_and_crop, tile_units
+from Hatch_Algorithm import HatchingSet, map_brightness_values, hatch_units_crosshatch
+from Unit_Reorderer import reorder_units_into_groups, get_raw_converted_total_lines
+from GCode_Controller import convert_to_gcode, iter_gcode
+from Preview_Renderer import render_preview
+from PIL import Image
+import numpy as np
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import tempfile
+import time
+
+DEFAULT_GRIDS = "1x1,2x2,5x5,10x10,20x20"
+
+################### SYNTHETIC IMAGES
+
+def synthetic_image(kind, size, seed=0):
+    """Return a grayscale PIL image of a made-up test pattern"""
+    width, height = size
+    yy, xx = np.mgrid[0:height, 0:width]
+    rng = np.random.default_rng(seed)
+
+    if kind == "black":
+        pixels = np.zeros((height, width))
+    elif kind == "white":
+        pixels = np.full((height, width), 255)
+    elif kind == "gradient":
+        pixels = 255 * (xx / max(width - 1, 1) + yy / max(height - 1, 1)) / 2
+    elif kind == "checkerboard":
+        square = max(min(width, height) // 16, 1)
+        pixels = 255 * (((xx // square) + (yy // square)) % 2)
+    elif kind == "noise":
+        pixels = rng.integers(0, 256, (height, width))
+    elif kind == "photo":
+        # soft blobs of light and dark with some grain, roughly like a portrait
+        pixels = np.full((height, width), 128.0)
+        for _ in range(12):
+            cx, cy = rng.uniform(0, width), rng.uniform(0, height)
+            radius = rng.uniform(0.05, 0.3) * min(width, height)
+            pixels += rng.uniform(-120, 120) * np.exp(-((xx - cx) ** 2 + (yy - cy) ** 2) / (2 * radius ** 2))
+        pixels += rng.normal(0, 12, (height, width))
+    else:
+        raise ValueError(f"Unknown synthetic image '{kind}'")
+
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), "L")
+
+SYNTHETIC_IMAGES = ("black", "white", "gradient", "checkerboard", "noise", "photo")
+
+################### TIMING
+
+def _timed(func, *args, repeat=1):
+    """Return (result of the last run, fastest time in seconds) of 'func' over 'repeat' runs"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+def benchmark_pipeline(img, dimensions, repeat=1):
+    """Time every stage of the pipeline for one image and grid size"""
+    times = {}
+
+    # loading straight at the print size from a file (see 'fast_image_loading')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "source.jpg")
+        img.convert("RGB").save(path, quality=92)
+        _, times["load_image"] = _timed(load_image, path, dimensions, pixels_per_unit_x, pixels_per_unit_y,
+                                        pixels_of_deadspace, repeat=repeat)
+
+    img, times["resize_and_crop"] = _timed(resize_and_crop, img, dimensions, pixels_per_unit_x,
+                                           pixels_per_unit_y, pixels_of_deadspace, repeat=repeat)
+    units, times["tile_units"] = _timed(
+        lambda: np.ascontiguousarray(tile_units(np.asarray(img), dimensions, pixels_per_unit_x,
+                                                pixels_per_unit_y, pixels_of_deadspace)
+                                     ).reshape(-1, pixels_per_unit_y, pixels_per_unit_x),
+        repeat=repeat)
+    _, times["map_brightness_values"] = _timed(map_brightness_values, units, repeat=repeat)
+    total_lines, times["create_hatching_set"] = _timed(
+        lambda: HatchingSet(units).create_hatching_set(), repeat=repeat)
+    crosshatch_lines, times["crosshatch"] = _timed(hatch_units_crosshatch, units, repeat=repeat)
+    _, times["render_preview"] = _timed(render_preview, total_lines, dimensions, repeat=repeat)
+
+    groups, times["reorder_units_into_groups"] = _timed(reorder_units_into_groups, total_lines, dimensions,
+                                                       repeat=repeat)
+    with contextlib.redirect_stdout(io.StringIO()):
+        raw_groups, times["get_raw_converted_total_lines"] = _timed(get_raw_converted_total_lines, groups)
+
+    gcode, times["convert_to_gcode"] = _timed(
+        lambda: [convert_to_gcode(group) for group in raw_groups], repeat=repeat)
+    compact_gcode, times["iter_gcode"] = _timed(
+        lambda: [list(iter_gcode(group)) for group in raw_groups], repeat=repeat)
+
+    return {
+        "times": times,
+        "units": len(units),
+        "lines": total_lines.num_lines,
+        "line_bytes": total_lines.nbytes,
+        "crosshatch_lines": crosshatch_lines.num_lines,
+        "printed_lines": sum(len(group) for group in raw_groups),
+        "commands": sum(len(group) for group in gcode),
+        "compact_commands": sum(len(group) for group in compact_gcode),
+    }
+
+def run_benchmarks(grids, images, repeat=1):
+    """Benchmark every image at every grid size and return the results"""
+    results = []
+    for grid in grids:
+        dimensions = tuple(int(n) for n in grid.lower().split("x"))
+        # make the source image bigger than the print so every grid gets downscaled
+        source_size = (max(1600, 2 * dimensions[0] * pixels_per_unit_x),
+                       max(1200, 2 * dimensions[1] * pixels_per_unit_y))
+        for kind in images:
+            result = benchmark_pipeline(synthetic_image(kind, source_size), dimensions, repeat)
+            result.update({"image": kind, "grid": grid})
+            results.append(result)
+            print(f"{grid:>6} {kind:<13} " + "  ".join(f"{stage} {seconds * 1000:.1f}ms"
+                                                       for stage, seconds in result["times"].items()))
+    return results
+
+def compare_results(old, new):
+    """Print how much faster (or slower) every stage got between two benchmark runs"""
+    old_runs = {(run["grid"], run["image"]): run for run in old["results"]}
+    for run in new["results"]:
+        old_run = old_runs.get((run["grid"], run["image"]))
+        if old_run is None:
+            continue
+        changes = []
+        for stage, seconds in run["times"].items():
+            if stage in old_run["times"] and seconds > 0:
+                changes.append(f"{stage} x{old_run['times'][stage] / seconds:.2f}")
+        print(f"{run['grid']:>6} {run['image']:<13} " + "  ".join(changes))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time every stage of the Linear Printer pipeline")
+    parser.add_argument("--grids", default=DEFAULT_GRIDS, help="comma separated grid sizes (units wide x high)")
+    parser.add_argument("--images", default=",".join(SYNTHETIC_IMAGES), help="comma separated synthetic images")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per stage (the fastest is kept)")
+    parser.add_argument("--out", default=f"bench_{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+    parser.add_argument("--compare", help="an earlier results file to compare against")
+    args = parser.parse_args()
+
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.platform(),
+        "settings": {"hatch_engine": hatch_engine, "hatch_workers": hatch_workers, "white_cap": white_cap,
+                     "pixels_of_deadspace": pixels_of_deadspace, "stroke_order": stroke_order,
+                     "use_stroke_stitching": use_stroke_stitching, "bed_units": [bed_units_x, bed_units_y]},
+        "results": run_benchmarks(args.grids.split(","), args.images.split(","), args.repeat),
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved results to {args.out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f), report)
@@ -7,77 +7,345 @@ send command by command of g-code to the lulzbot.
 #############################################################
 """
 
-import serial, time
+import serial, time, queue, threading
+from collections import deque
+from functools import reduce
+from operator import xor
+import numpy as np
 from Univ_Settings import *
+from Metrics import metrics
 
-def establish_printer_connection(port, baudr):
-    """Create a connection with the printer"""
+def establish_printer_connection(port, baudr, settle_time=2):
+    """Create a connection with the printer. 'port' can also be a pyserial URL
+    (e.g. 'socket://localhost:5000' or 'loop://' for testing without a printer)"""
     try:
-        ser = serial.Serial(port, baudr, timeout=1)     # timeout for establish connection
-        time.sleep(2)
+        ser = serial.serial_for_url(port, baudr, timeout=1)     # timeout for establish connection
+        # (opening the port resets the printer's board, so give it time to start up)
+        time.sleep(settle_time)
         print(f"Connected to printer on port {port}")
         # clear buffer messages from printer
         while ser.in_waiting:
             ser.readline()
-        return ser
+        return PrinterLink(ser)
     except serial.SerialException as e:
         print(f"Encountered error from printer: {e}")
         return None
 
-def send_gcode_command(ser, cmd):
+class PrinterLink:
+    """A serial connection to the printer. A background thread reads every response into a queue (so
+    nothing has to poll the port), and every command is framed as 'N<line> <cmd>*<checksum>' so the
+    firmware can spot a corrupted line and ask for it again from the history of sent lines."""
+
+    def __init__(self, ser, line_numbers=use_line_numbers, history_size=resend_history_size):
+        self.ser = ser
+        self.line_numbers = line_numbers
+        self.history_size = history_size
+
+        # responses from the printer (filled by the reader thread)
+        self.responses = queue.Queue()
+
+        # framed bytes of recently sent lines by line number (for resends)
+        self.history = {}
+        self.next_line_number = 1
+
+        # every sent line waits for an 'ok': (resend epoch it was sent in, byte length, time sent), oldest first
+        self.in_flight = deque()
+        self.bytes_in_flight = 0
+
+        # line numbers the printer asked for again, and a counter bumped on every rewind so stale
+        # resend requests (for lines sent before the rewind) are ignored
+        self.resend_queue = deque()
+        self.resend_epoch = 0
+        self.requested_resend = None
+
+        # running totals
+        self.num_resends = 0
+        self.num_timeouts = 0
+
+        self.running = True
+        self.reader = threading.Thread(target=self._read_responses, daemon=True)
+        self.reader.start()
+
+        # start the firmware's line numbers over (this is line N0, the next line is N1)
+        if self.line_numbers:
+            self.next_line_number = 0
+            self.send_command("M110 N0")
+
+    ################## READER THREAD
+
+    def _read_responses(self):
+        """Reader thread: put every line from the printer into the response queue"""
+        while self.running:
+            try:
+                # (readline blocks for up to the connection's timeout)
+                line = self.ser.readline()
+            except (serial.SerialException, OSError, TypeError):
+                self.responses.put(None)        # connection lost
+                break
+            if line:
+                self.responses.put(line.decode('utf-8', errors='replace').strip())
+
+    def close(self):
+        """Stop the reader thread and close the port"""
+        self.running = False
+        self.reader.join(timeout=2)
+        self.ser.close()
+
+    ################## SENDING
+
+    def frame(self, line_number, cmd):
+        """Return the bytes for a command (from 'clean_command') with its line number and checksum"""
+        if not self.line_numbers:
+            return cmd + b'\n'
+        line = b'N%d %s' % (line_number, cmd)
+        return b'%s*%d\n' % (line, reduce(xor, line, 0))
+
+    def _write(self, framed):
+        self.ser.write(framed)
+        self.in_flight.append((self.resend_epoch, len(framed), time.perf_counter()))
+        self.bytes_in_flight += len(framed)
+
+    def send_command(self, cmd, timeout=10):
+        """Send a single command and wait for it to be acknowledged (lockstep)"""
+        return self.stream([cmd], max_in_flight=1, timeout=timeout)
+
+    def stream(self, gcode, rx_buffer_size=printer_rx_buffer_size, max_in_flight=max_commands_in_flight, timeout=10):
+        """Send commands while keeping several in flight so the printer's planner never runs dry.
+        Every sent line takes up room in the firmware's receive buffer until its 'ok' comes back
+        (character counting), so the next line is only sent when both its bytes and the number of
+        unacknowledged lines fit. Lines the printer asks for again are re-sent first."""
+        commands = iter(gcode)
+        next_cmd = None
+        all_ok = True
+
+        while True:
+            # resends go ahead of new commands
+            if self.resend_queue:
+                line_number = self.resend_queue[0]
+                framed = self.history[line_number]
+            else:
+                if next_cmd is None:
+                    next_cmd = next(commands, None)
+                    if next_cmd is None:
+                        break
+                    next_cmd = clean_command(next_cmd)
+                    if not next_cmd:
+                        next_cmd = None         # blank line or comment
+                        continue
+                line_number = self.next_line_number
+                framed = self.frame(line_number, next_cmd)
+
+            fits = (self.bytes_in_flight + len(framed) <= rx_buffer_size and len(self.in_flight) < max_in_flight)
+            if self.in_flight and not fits:
+                all_ok = self.wait_for_response(timeout) and all_ok
+                continue
+
+            self._write(framed)
+            if self.resend_queue:
+                self.resend_queue.popleft()
+            else:
+                self._remember(line_number, framed)
+                next_cmd = None
+
+        # wait for the last lines to be acknowledged (and re-send any that are asked for)
+        while self.in_flight or self.resend_queue:
+            if self.resend_queue and len(self.in_flight) < max_in_flight:
+                line_number = self.resend_queue.popleft()
+                self._write(self.history[line_number])
+            else:
+                all_ok = self.wait_for_response(timeout) and all_ok
+
+        return all_ok
+
+    def _remember(self, line_number, framed):
+        """Add a sent line to the history ring buffer"""
+        if not self.line_numbers:
+            return
+        self.history[line_number] = framed
+        self.history.pop(line_number - self.history_size, None)
+        self.next_line_number += 1
+
+    ################## RESPONSES
+
+    def wait_for_response(self, timeout=10):
+        """Handle responses until the oldest line in flight is acknowledged. Returns False if a line
+        was lost (the printer didn't answer in time, or asked for a line no longer in the history)"""
+        while True:
+            try:
+                response = self.responses.get(timeout=timeout)
+            except queue.Empty:
+                print(f"Warning: Did not get 'ok' with {len(self.in_flight)} lines in flight")
+                self.num_timeouts += 1
+                metrics.count_event("timeouts")
+                self._acknowledge()
+                return False
+
+            if response is None:
+                raise serial.SerialException("Lost connection to the printer")
+
+            lowered = response.lower()
+            if lowered.startswith('ok'):
+                return self._acknowledge()
+            elif lowered.startswith('resend') or lowered.startswith('rs '):
+                # the firmware follows this with an 'ok' for the bad line
+                self.requested_resend = int(''.join(c for c in response.split(':')[-1] if c.isdigit()) or 0)
+            elif lowered.startswith('error') and 'line' not in lowered and 'checksum' not in lowered:
+                # (bad lines are reported when the resend is handled)
+                print(f"Printer error: {response}")
+            # anything else (echo, 'busy: processing', temperatures) just means the printer is still there
+
+    def _acknowledge(self):
+        """An 'ok' frees the oldest line in flight and starts any resend asked for with it. Returns
+        False if the line asked for can't be re-sent"""
+        if not self.in_flight:
+            return True
+        epoch, num_bytes, sent_time = self.in_flight.popleft()
+        self.bytes_in_flight -= num_bytes
+        metrics.record_latency(time.perf_counter() - sent_time)
+
+        line_number, self.requested_resend = self.requested_resend, None
+        if line_number is None:
+            return True
+        # lines sent before the last rewind get answered with the same request again (already handled)
+        if epoch != self.resend_epoch:
+            return True
+        if line_number not in self.history:
+            print(f"Printer requested resend of line {line_number}, which is no longer in the history ( ._.)")
+            return False
+
+        # rewind: everything from the requested line on is sent again, in order
+        print(f"Printer requested resend from line {line_number}")
+        self.num_resends += 1
+        metrics.count_event("resends")
+        self.resend_epoch += 1
+        self.resend_queue = deque(range(line_number, self.next_line_number))
+        return True
+
+def clean_command(cmd):
+    """Return a command as bytes without its comment or surrounding whitespace"""
+    if isinstance(cmd, str):
+        cmd = cmd.encode('utf-8')
+    return cmd.split(b';')[0].strip()
+
+def send_gcode_command(link, cmd):
     """Send a single g-code command to the printer"""
-    cmd_bytes = (cmd + '\n').encode('utf-8')
-    ser.write(cmd_bytes)
-
-    response = ""
-    start_time = time.time()
-    # wait for 'ok' or 'resend' or a timeout
-    while 'ok' not in response and 'resend' not in response and (time.time() - start_time < 10):    # 10 sec timeout
-        if ser.in_waiting:
-            line = ser.readline().decode('utf-8').strip()
-            response += line
-
-    if 'ok' not in response:
-        print(f"Warning: Did not get 'ok' for {cmd} - {response}")
-        if 'resend' in response:
-            print("Printer requested resend.... ( ._.)")
-        return False    # cmd failed, etc.
-    return True         # cmd successful
+    return link.send_command(cmd)
+
+def stream_gcode_commands(link, gcode, rx_buffer_size=printer_rx_buffer_size, max_in_flight=max_commands_in_flight):
+    """Send g-code commands while keeping several in flight (see 'PrinterLink.stream')"""
+    return link.stream(gcode, rx_buffer_size, max_in_flight)
+
+def start_gcode():
+    """The g-code that orients the pen before all unit group prints"""
+    return [
+        "G90",                                                                          # change to absolute positioning
+        "G28",                                                                          # home axis
+        "G21",                                                                          # make sure g-code is in mm
+        f"G0 X{x_print_start_offset} Y{y_print_start_offset} Z{z_print_start_offset}",  # move away from starting marker
+        f"G92 X0 Y0",                                                                   # reset origin to current pos
+        "G0 Y130",
+        f"G1 Z{z_lift_level} F{print_speed}",                                           # descend slightly
+    ]
+
+def group_end_gcode():
+    """The g-code that moves the pen out of the way after a unit group is printed"""
+    return f"G0 X0 Y{bed_units_y * pixels_per_unit_y}"
 
 def prepare_print(ser):
     """Prepare to do all unit group prints (start g-code)"""
     # orient the pen
-    send_gcode_command(ser, "G90")                                                                              # change to absolute positioning
-    send_gcode_command(ser, "G28")                                                                              # home axis
-    send_gcode_command(ser, "G21")                                                                              # make sure g-code is in mm
-    send_gcode_command(ser, f"G0 X{x_print_start_offset} Y{y_print_start_offset} Z{z_print_start_offset}")      # move away from starting marker
-    send_gcode_command(ser, f"G92 X0 Y0")                                                                       # reset origin to current pos
-    send_gcode_command(ser, "G0 Y130")
-    send_gcode_command(ser, f"G1 Z{z_lift_level} F{print_speed}")                                               # descend slightly
+    for cmd in start_gcode():
+        send_gcode_command(ser, cmd)
 
 def print_unit_group(ser, gcode):
-    """Control printer and print out onto 2x2 sticky notes the lines in 'gcode' on the bed"""
+    """Control printer and print out onto the sticky notes on the bed the lines in 'gcode'.
+    Returns False if any line wasn't acknowledged"""
     # draw all the lines
-    for cmd in gcode:
-        send_gcode_command(ser, cmd)
+    if use_streaming_sender:
+        all_ok = stream_gcode_commands(ser, gcode)
+    else:
+        # lockstep fallback (wait for every 'ok' before sending the next command)
+        all_ok = True
+        for cmd in gcode:
+            all_ok = send_gcode_command(ser, cmd) and all_ok
 
-    send_gcode_command(ser, f"G0 X0 Y{2 * pixels_per_unit_y}")
-
-    return None
+    return send_gcode_command(ser, group_end_gcode()) and all_ok
 
 def convert_to_gcode(raw_line_set):
-    """Convert a set of lines (for 4 units) to g-code commands"""
+    """Convert a set of lines (for a bed load of units) to g-code commands"""
     gcode_command_set = []
 
-    for line in raw_line_set:
-        flipped_xa = (2 * pixels_per_unit_x) - line[0]
-        flipped_xb = (2 * pixels_per_unit_x) - line[2]
-
-        gcode_command_set.append(f"G0 X{flipped_xa} Y{line[1]} F{travel_speed}")
+    for flipped_xa, y1, flipped_xb, y2 in _flipped_lines(raw_line_set):
+        gcode_command_set.append(f"G0 X{flipped_xa} Y{y1} F{travel_speed}")
         gcode_command_set.append(f"G0 Z{z_draw_level} F{travel_speed}")
-        gcode_command_set.append(f"G1 X{flipped_xb} Y{line[3]} F{print_speed}")
+        gcode_command_set.append(f"G1 X{flipped_xb} Y{y2} F{print_speed}")
         gcode_command_set.append(f"G0 Z{z_lift_level} F{travel_speed}")
 
     return gcode_command_set
 
+def _flipped_lines(raw_line_set):
+    """Return the lines (an (n, 4) array or a list of [x1, y1, x2, y2]) as (x1, y1, x2, y2) tuples of
+    plain ints, with the x coords flipped to the printer's direction all at once"""
+    lines = np.array(raw_line_set, dtype=np.int64).reshape(-1, 4)
+    lines[:, [0, 2]] = (bed_units_x * pixels_per_unit_x) - lines[:, [0, 2]]
+    # (four long lists are much quicker to make than a short list per line)
+    return zip(*lines.T.tolist())
+
+def _gcode_number(value):
+    """Format a coordinate or feedrate the way it's written in g-code (no trailing zeros)"""
+    if float(value).is_integer():
+        return b'%d' % value
+    return (b'%.3f' % value).rstrip(b'0').rstrip(b'.')
+
+def iter_gcode(raw_line_set, merge_lift=merge_lift_travel):
+    """Lazily convert a set of lines (for a bed load of units) to compact, pre-encoded g-code commands.
+    Unlike 'convert_to_gcode', words that wouldn't change anything (the same feedrate, an axis
+    that isn't moving) are left out, travel to where the pen already is is skipped (so the pen
+    stays down between lines that meet), and with 'merge_lift' the lift is done during the travel"""
+    pos = {b'X': None, b'Y': None, b'Z': None}
+    feedrate = None
+
+    def move(g, axes, speed):
+        # only the axes that move (and the feedrate if it changed) are written
+        nonlocal feedrate
+        words = [g]
+        for axis, value in axes:
+            if pos[axis] != value:
+                words.append(axis + _gcode_number(value))
+                pos[axis] = value
+        if len(words) == 1:
+            return None
+        if speed != feedrate:
+            words.append(b'F' + _gcode_number(speed))
+            feedrate = speed
+        return b' '.join(words)
+
+    for flipped_xa, y1, flipped_xb, y2 in _flipped_lines(raw_line_set):
+        if (pos[b'X'], pos[b'Y']) != (flipped_xa, y1):
+            if pos[b'Z'] == z_draw_level and merge_lift:
+                # lift on the way to the next line
+                yield move(b'G0', [(b'X', flipped_xa), (b'Y', y1), (b'Z', z_lift_level)], travel_speed)
+            else:
+                if pos[b'Z'] == z_draw_level:
+                    yield move(b'G0', [(b'Z', z_lift_level)], travel_speed)
+                yield move(b'G0', [(b'X', flipped_xa), (b'Y', y1)], travel_speed)
+
+        cmd = move(b'G0', [(b'Z', z_draw_level)], travel_speed)
+        if cmd:
+            yield cmd
+        cmd = move(b'G1', [(b'X', flipped_xb), (b'Y', y2)], print_speed)
+        if cmd:
+            yield cmd
+
+    # lift the pen off the last line
+    if pos[b'Z'] == z_draw_level:
+        yield move(b'G0', [(b'Z', z_lift_level)], travel_speed)
 
+def generate_gcode(raw_line_set, group=None):
+    """Return the g-code commands for a set of lines, compact or not depending on 'compact_gcode'
+    (the compact commands are a one-use generator, so call this again to print the same set again).
+    When collecting metrics, the commands are counted against unit group 'group' as they're used"""
+    gcode = iter_gcode(raw_line_set) if compact_gcode else convert_to_gcode(raw_line_set)
+    if group is not None and metrics.enabled:
+        return metrics.meter_gcode(gcode, group)
+    return gcode
@@ -0,0 +1,189 @@
+"""
+#############################################################
+SUMMARY: This script saves a job's g-code to files instead of
+sending it straight to the printer, so jobs can be made on a
+fast machine and printed later on the printer's own computer.
+Replaying only needs this file, 'GCode_Controller.py',
+'Metrics.py' and 'Univ_Settings.py' (and the pyserial and
+numpy packages), not the image/hatching/pygame pipeline.
+Either one file per unit group or one job file with a marker
+before each group is written. Commands are streamed into the
+file one at a time, so a whole job is never held in memory.
+Each file starts with a header of comments describing it.
+
+USAGE:
+    python GCode_Exporter.py export [output path] [--per-group]
+    python GCode_Exporter.py replay <job file> [--port COM3] [--baud 256000]
+#############################################################
+"""
+
+from Univ_Settings import *
+
+from GCode_Controller import *
+import argparse
+import datetime
+import os
+
+# every unit group in a job file starts with a line like '; GROUP 2/6'
+GROUP_MARKER = b"; GROUP "
+
+# size of the write buffer for job files
+WRITE_BUFFER_SIZE = 1 << 16
+
+################### EXPORTING
+
+def default_job_settings():
+    """The image settings of a job run straight from 'Univ_Settings.py'"""
+    return {
+        "image": image_path,
+        "units_wide": units_wide,
+        "units_high": units_high,
+        "white_cap": white_cap,
+        "pixels_of_deadspace": pixels_of_deadspace,
+        "hatch_engine": hatch_engine,
+    }
+
+def _header(lines, job_settings=None):
+    """Comment lines describing the job settings"""
+    job = default_job_settings()
+    job.update(job_settings or {})
+    header = [
+        "; Linear Printer job",
+        f"; created: {datetime.datetime.now().isoformat(timespec='seconds')}",
+        f"; image: {os.path.basename(str(job['image']).replace(chr(92), '/'))}",
+        f"; units: {job['units_wide']} wide x {job['units_high']} high, white_cap: {job['white_cap']}, "
+        f"pixels_of_deadspace: {job['pixels_of_deadspace']}, hatch_engine: {job['hatch_engine']}",
+        f"; pixels_per_unit: {pixels_per_unit_x} x {pixels_per_unit_y}, bed: {bed_units_x} x {bed_units_y} units",
+        f"; print_speed: {print_speed}, travel_speed: {travel_speed}, "
+        f"z_draw_level: {z_draw_level}, z_lift_level: {z_lift_level}",
+    ]
+    return header + lines
+
+def _group_header(group_num, num_groups, raw_line_set):
+    """Marker and comment lines describing one unit group"""
+    # (imported here so replaying a job doesn't need the simulator)
+    from Print_Simulator import simulate_gcode, format_estimate
+
+    # (the simulator reads the commands one at a time, so they're generated twice rather than kept)
+    estimate = simulate_gcode(iter_group_gcode(raw_line_set))
+    return [
+        f"{GROUP_MARKER.decode()}{group_num}/{num_groups}",
+        f"; lines: {len(raw_line_set)}",
+        f"; estimated duration: {format_estimate(estimate)}",
+    ]
+
+def iter_group_gcode(raw_line_set):
+    """All the commands for printing one unit group"""
+    yield from generate_gcode(raw_line_set)
+    yield group_end_gcode()
+
+def _write_lines(f, lines):
+    for line in lines:
+        if isinstance(line, str):
+            line = line.encode("utf-8")
+        f.write(line + b"\n")
+
+def _write_group(f, group_num, num_groups, raw_line_set):
+    _write_lines(f, _group_header(group_num, num_groups, raw_line_set))
+    _write_lines(f, iter_group_gcode(raw_line_set))
+
+def export_job(raw_converted_total_lines, path, per_group=False, job_settings=None):
+    """Write the g-code for every unit group to 'path' (a job file), or with 'per_group' to one
+    file per group next to it ('job.gcode' -> 'job_group01.gcode', ...). Returns the files written.
+    'job_settings' overrides the image settings written in the header (see 'default_job_settings')"""
+    num_groups = len(raw_converted_total_lines)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    if not per_group:
+        with open(path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            _write_lines(f, _header([f"; groups: {num_groups}"], job_settings))
+            _write_lines(f, start_gcode())
+            for i, raw_line_set in enumerate(raw_converted_total_lines):
+                _write_group(f, i + 1, num_groups, raw_line_set)
+        return [path]
+
+    # every group file can be printed on its own, so each one orients the pen first
+    stem, ext = os.path.splitext(path)
+    paths = []
+    for i, raw_line_set in enumerate(raw_converted_total_lines):
+        group_path = f"{stem}_group{i + 1:0{len(str(num_groups))}d}{ext or '.gcode'}"
+        with open(group_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            _write_lines(f, _header([f"; group {i + 1} of {num_groups}"], job_settings))
+            _write_lines(f, start_gcode())
+            _write_group(f, i + 1, num_groups, raw_line_set)
+        paths.append(group_path)
+    return paths
+
+################### REPLAYING
+
+def iter_job_sections(path):
+    """Lazily read a job file as (group marker, commands) pairs. The start g-code comes first with a
+    marker of None. Each section's commands must be used up before asking for the next section"""
+    with open(path, "rb") as f:
+        marker = None
+        next_marker = []
+
+        def commands():
+            for line in f:
+                line = line.strip()
+                if line.startswith(GROUP_MARKER):
+                    next_marker.append(line[2:].decode("utf-8"))
+                    return
+                if line and not line.startswith(b";"):
+                    yield line
+
+        while True:
+            yield marker, commands()
+            if not next_marker:
+                return
+            marker = next_marker.pop()
+
+def replay_job(path, port=printer_port, baudr=baud_rate):
+    """Print an exported job file, waiting for the operator before every unit group"""
+    printer = establish_printer_connection(port, baudr)
+    if not printer:
+        return False
+
+    for marker, commands in iter_job_sections(path):
+        if marker is not None:
+            if input(f"Load the notes for {marker} and press enter... (type 'skip' to skip) ").lower() == "skip":
+                for _ in commands:
+                    pass
+                continue
+        stream_gcode_commands(printer, commands)
+
+    printer.close()
+    print("*DING* Your print is ready. Yay!")
+    return True
+
+################### COMMAND LINE
+
+def _export_from_settings(path, per_group):
+    """Run the hatching pipeline for the image in 'Univ_Settings.py' and export it"""
+    # (imported here so replaying doesn't need the image pipeline installed)
+    from Hatch_Cache import cached_hatching_set
+    from Unit_Reorderer import reorder_units_into_groups, get_raw_converted_total_lines
+
+    _, total_lines_set = cached_hatching_set()
+    raw_converted_total_lines = get_raw_converted_total_lines(reorder_units_into_groups(total_lines_set))
+    for written in export_job(raw_converted_total_lines, path, per_group):
+        print(f"Wrote {written}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export or replay Linear Printer g-code jobs")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="hatch the image in Univ_Settings.py and save its g-code")
+    export_parser.add_argument("path", nargs="?", default=os.path.join(gcode_export_dir, "job.gcode"))
+    export_parser.add_argument("--per-group", action="store_true", help="write one file per unit group")
+
+    replay_parser = commands.add_parser("replay", help="print a saved job file")
+    replay_parser.add_argument("path")
+    replay_parser.add_argument("--port", default=printer_port)
+    replay_parser.add_argument("--baud", type=int, default=baud_rate)
+
+    args = parser.parse_args()
+    if args.command == "export":
+        _export_from_settings(args.path, args.per_group)
+    else:
+        replay_job(args.path, args.port, args.baud)
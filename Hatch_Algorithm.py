@@ -11,12 +11,26 @@ printing.
 
 from Univ_Settings import *
 
+from Metrics import metrics
+from Line_Set import LineSet
+from functools import lru_cache
+from multiprocessing import Pool
+import numpy as np
+import os
+
 
 ################### LINE WRITING LOGIC FUNCS
 # these funcs check if a pixel should be dark depending on how many above are
 # covered. for some shades, there must be 1 dark pixel per 4 pixels (checked
 # vertically.) EX: 'check_1by2' means draw pixel if above space is empty (1 pixel
 # per 2 pixels)
+#
+# 'drawn_points' is a boolean bitmap shaped like the unit (indexed [y, x]), so
+# every lookup is constant time instead of a scan through a list of points
+
+def is_covered(drawn_points, x, y):
+    """Return True if the pixel at [x, y] has already been drawn (off-unit pixels never are)"""
+    return y >= 0 and bool(drawn_points[y, x])
 
 def check_1by4(drawn_points, pos, unit_brightness_array):
     """
@@ -25,13 +39,13 @@ def check_1by4(drawn_points, pos, unit_brightness_array):
     x = pos[0]
     y = pos[1]
     can_draw = (
-        [x, y-1] not in drawn_points and
-         [x, y-2] not in drawn_points and
-          [x, y-3] not in drawn_points
+        not is_covered(drawn_points, x, y-1) and
+         not is_covered(drawn_points, x, y-2) and
+          not is_covered(drawn_points, x, y-3)
     )
 
     if can_draw:
-        drawn_points.append([x, y])
+        drawn_points[y, x] = True
     return can_draw
 
 def check_1by2(drawn_points, pos, unit_brightness_array):
@@ -40,9 +54,9 @@ def check_1by2(drawn_points, pos, unit_brightness_array):
     """
     x = pos[0]
     y = pos[1]
-    can_draw = ([x, y-1] not in drawn_points or unit_brightness_array[x, y-1] != 4)
+    can_draw = (not is_covered(drawn_points, x, y-1) or unit_brightness_array[x, y-1] != 4)
     if can_draw:
-        drawn_points.append([x, y])
+        drawn_points[y, x] = True
     return can_draw
 
 def check_2by3(drawn_points, pos, unit_brightness_array):
@@ -54,14 +68,14 @@ def check_2by3(drawn_points, pos, unit_brightness_array):
     num_above = 0
 
     # check the above 2 lines (must be 1 or less lines in the above 2 spaces)
-    if [x, y-1] in drawn_points and unit_brightness_array[x, y-1] == 3:
+    if is_covered(drawn_points, x, y-1) and unit_brightness_array[x, y-1] == 3:
         num_above += 1
-    if [x, y-2] in drawn_points and unit_brightness_array[x, y-2] == 3:
+    if is_covered(drawn_points, x, y-2) and unit_brightness_array[x, y-2] == 3:
         num_above += 1
 
     can_draw = (num_above <= 1)
     if can_draw:
-        drawn_points.append([x, y])
+        drawn_points[y, x] = True
     return can_draw
 
 def check_3by4(drawn_points, pos, unit_brightness_array):
@@ -73,20 +87,259 @@ def check_3by4(drawn_points, pos, unit_brightness_array):
     num_above = 0
 
     for i in range(1, 4):
-        if [x, y-i] in drawn_points and unit_brightness_array[x, y-i] == 2:
+        if is_covered(drawn_points, x, y-i) and unit_brightness_array[x, y-i] == 2:
             num_above += 1
 
     can_draw = (num_above <= 2)
     if can_draw:
-        drawn_points.append([x, y])
+        drawn_points[y, x] = True
     return can_draw
 
+################### TONE MAPPING
+# raw brightness values are 0-255, so the light value of every possible pixel
+# is worked out once per 'white_cap' and the image is mapped with a single lookup
+
+@lru_cache(maxsize=None)
+def tone_lookup_table(white_cap=white_cap):
+    """Return a read-only 256 entry table of light values 6 (brightest, white) to 1 (darkest)"""
+    lookup_table = np.empty(256, dtype=np.uint8)
+    remaining_range = white_cap / 5
+    for light_val in range(256):
+        # if pixel should be white
+        if light_val >= white_cap:
+            lookup_table[light_val] = 6
+        else:
+            # map remaining values onto a light value 1-5
+            for i in range(1, 6):
+                if light_val <= (i * remaining_range):
+                    lookup_table[light_val] = i
+                    break
+
+    lookup_table.setflags(write=False)
+    return lookup_table
+
+def map_brightness_values(brightness_array, white_cap=white_cap):
+    """Return a new uint8 array of light values for a unit (or a whole stack of units) of raw brightness values"""
+    # (the raw array is left untouched so it can be re-mapped with other tone settings)
+    with metrics.stage("tone_mapping"):
+        return tone_lookup_table(white_cap)[np.asarray(brightness_array)]
+
+################### NUMPY ENGINE
+# the density rules above only ever look at the same column in earlier rows, so
+# rather than visiting pixels one at a time, a whole row can be decided at once
+# for every column of every unit in a stack. The rules are the same as the
+# 'check_*' funcs (including their '[x, y-k]' lookup into the light values).
+
+def build_draw_mask(light_values):
+    """Return a boolean array shaped like 'light_values' (units, y, x) of all pixels to draw"""
+    light_values = np.asarray(light_values)
+    if light_values.ndim == 2:
+        light_values = light_values[np.newaxis]
+
+    num_units, unit_height, unit_width = light_values.shape
+
+    # the checkers read 'unit_brightness_array[x, y-k]', so compare against the transposed units
+    light_values_t = light_values.transpose(0, 2, 1)
+
+    # covered pixels (and covered pixels of a given light value) per row, with
+    # 3 blank rows on top standing in for the space above the unit
+    covered = np.zeros((unit_height + 3, num_units, unit_width), dtype=np.int8)
+    covered_as = {val: np.zeros_like(covered) for val in (2, 3, 4)}
+
+    draw_mask = np.zeros(light_values.shape, dtype=bool)
+    for y in range(unit_height):
+        row = light_values[:, y, :]
+        r = y + 3       # index of this row in the padded arrays
+
+        can_draw = (
+            (row == 1) |
+            ((row == 2) & (covered_as[2][r-1] + covered_as[2][r-2] + covered_as[2][r-3] <= 2)) |
+            ((row == 3) & (covered_as[3][r-1] + covered_as[3][r-2] <= 1)) |
+            ((row == 4) & (covered_as[4][r-1] == 0)) |
+            ((row == 5) & (covered[r-1] + covered[r-2] + covered[r-3] == 0))
+        )
+        draw_mask[:, y, :] = can_draw
+
+        covered[r] = can_draw
+        for val, covered_val in covered_as.items():
+            covered_val[r] = can_draw & (light_values_t[:, y, :] == val)
+
+    return draw_mask
+
+def mask_to_lines(draw_mask):
+    """Pull the horizontal runs out of a draw mask as a LineSet of [x1, y1, x2, y2] lines"""
+    num_units, _, unit_width = draw_mask.shape
+
+    # pad each row with a blank pixel either side so every run has a start and an end
+    padded = np.zeros((num_units, draw_mask.shape[1], unit_width + 2), dtype=np.int8)
+    padded[:, :, 1:-1] = draw_mask
+    edges = np.diff(padded, axis=2)
+    u_starts, y_starts, x_starts = np.nonzero(edges == 1)
+    _, _, x_ends = np.nonzero(edges == -1)
+
+    # a line ends on the first blank pixel after it, or on the last pixel of the row
+    x_ends = np.minimum(x_ends, unit_width - 1)
+
+    # (the runs come out of 'nonzero' in unit order, so the units' lines are already together)
+    lines = np.stack([x_starts, y_starts, x_ends, y_starts], axis=1)
+    return LineSet.from_counts(lines, np.bincount(u_starts, minlength=num_units))
+
+def hatch_units_numpy(brightness_arrays, white_cap=white_cap):
+    """Hatch a whole stack of units at once and return their lines (same output as 'NewUnit')"""
+    light_values = map_brightness_values(np.asarray(brightness_arrays), white_cap)
+    return mask_to_lines(build_draw_mask(light_values))
+
+def hatch_units_python(brightness_arrays, white_cap=white_cap):
+    """Hatch units one at a time, pixel by pixel, with 'NewUnit' and return their lines"""
+    unit_lines = []
+    for unit in brightness_arrays:
+        new_unit = NewUnit(unit, white_cap)
+        new_unit.hatch_note()
+        unit_lines.append(new_unit.linesToPrint)
+    return LineSet.from_units(unit_lines)
+
+# every engine takes a list of unit brightness arrays and returns a LineSet of every unit's lines
+HATCH_ENGINES = {
+    "python": hatch_units_python,
+    "numpy": hatch_units_numpy,
+}
+
+def register_hatch_engine(name):
+    """Decorator that makes a hatching func selectable by name (as 'hatch_engine', or per job). It's
+    called as 'engine(brightness_arrays, white_cap)' with a stack of units (units, y, x) of raw
+    brightness values, and returns a LineSet of every unit's lines in unit coords"""
+    def decorator(engine):
+        HATCH_ENGINES[name] = engine
+        return engine
+    return decorator
+
+################### CROSS-HATCH ENGINE
+# instead of packing more and more rows into darker tones, every tone gets layers of
+# long lines at different angles: 0 degrees over everything that isn't white, then
+# 90, 45 and 135 degrees as the tone gets darker. Each layer is a set of evenly spaced
+# lines across the unit, and a line is drawn wherever it passes over pixels dark enough
+# for its layer (every line of every layer of every unit is clipped at once, scanline
+# style, by sampling the tone mask along it). Neighbouring tones share layers, so the
+# strokes run on through mid-tones instead of breaking up into short runs.
+
+# (angle in degrees, lightest light value the layer is drawn over, offset in line spacings)
+CROSSHATCH_LAYERS = (
+    (0, 5, 0),
+    (90, 4, 0),
+    (45, 3, 0),
+    (135, 2, 0),
+    (0, 1, 0.5),
+    (90, 1, 0.5),
+)
+
+def layer_paths(angle, unit_width, unit_height, spacing=crosshatch_spacing, offset=0):
+    """Return (x, y, on_unit) arrays shaped (lines, steps) of the pixels every line of a layer passes
+    through, in order along the line ('on_unit' is False where the line is off the edge of the unit)"""
+    steps = np.arange(max(unit_width, unit_height))
+    # diagonal lines are closer together for the same step along an edge, so they're stepped further apart
+    step = spacing if angle in (0, 90) else max(round(spacing * np.sqrt(2)), 1)
+    first = int(round(offset * step))
+
+    if angle == 0:
+        x, y = steps[None, :], np.arange(first, unit_height, step)[:, None]
+    elif angle == 90:
+        x, y = np.arange(first, unit_width, step)[:, None], steps[None, :]
+    elif angle == 45:
+        # up and to the right (x + y is the same along a line)
+        diagonals = np.arange(first, unit_width + unit_height - 1, step)[:, None]
+        x, y = steps[None, :], diagonals - steps
+    elif angle == 135:
+        # down and to the right (x - y is the same along a line)
+        diagonals = np.arange(first - unit_height + 1, unit_width, step)[:, None]
+        x, y = steps[None, :], steps - diagonals
+    else:
+        raise ValueError(f"Cross-hatch layers can only be at 0, 45, 90 or 135 degrees, not {angle}")
+    x, y = np.broadcast_arrays(x, y)
+
+    on_unit = (x >= 0) & (x < unit_width) & (y >= 0) & (y < unit_height)
+    return np.clip(x, 0, unit_width - 1), np.clip(y, 0, unit_height - 1), on_unit
+
+def clip_layer(layer_mask, angle, spacing=crosshatch_spacing, offset=0, max_gap=crosshatch_max_gap,
+               min_length=crosshatch_min_length):
+    """Return (lines, unit of every line) of one layer across a stack of units, where 'layer_mask'
+    (units, y, x) is True on every pixel the layer is drawn over"""
+    num_units, unit_height, unit_width = layer_mask.shape
+    x, y, on_unit = layer_paths(angle, unit_width, unit_height, spacing, offset)
+
+    # the mask along every line of every unit, padded with a blank pixel either end so every run ends
+    sampled = np.zeros((num_units,) + x.shape[:1] + (x.shape[1] + 2,), dtype=np.int8)
+    sampled[:, :, 1:-1] = layer_mask[:, y, x] & on_unit
+    edges = np.diff(sampled, axis=2)
+    units, paths, starts = np.nonzero(edges == 1)
+    _, _, ends = np.nonzero(edges == -1)        # (one past the last pixel of each run)
+
+    # runs along the same line with a gap of at most 'max_gap' pixels become one stroke
+    # (the runs come out of 'nonzero' in order of unit, line, then position along the line)
+    new_stroke = np.ones(len(starts), dtype=bool)
+    new_stroke[1:] = ((units[1:] != units[:-1]) | (paths[1:] != paths[:-1]) |
+                      (starts[1:] - ends[:-1] > max_gap))
+    stroke_starts = np.flatnonzero(new_stroke)
+    if len(stroke_starts):
+        units, paths, starts = units[stroke_starts], paths[stroke_starts], starts[stroke_starts]
+        ends = np.maximum.reduceat(ends, stroke_starts)
+
+    # strokes that would barely be a dot aren't worth dropping the pen for
+    long_enough = ends - starts >= min_length
+    units, paths, starts, last = units[long_enough], paths[long_enough], starts[long_enough], ends[long_enough] - 1
+
+    lines = np.stack([x[paths, starts], y[paths, starts], x[paths, last], y[paths, last]], axis=1)
+    return lines, units
+
+@register_hatch_engine("crosshatch")
+def hatch_units_crosshatch(brightness_arrays, white_cap=white_cap, layers=CROSSHATCH_LAYERS,
+                           spacing=crosshatch_spacing, max_gap=crosshatch_max_gap, min_length=crosshatch_min_length):
+    """Hatch a whole stack of units with layers of lines at 0/45/90/135 degrees (see 'CROSSHATCH_LAYERS')"""
+    light_values = map_brightness_values(np.asarray(brightness_arrays), white_cap)
+    if light_values.ndim == 2:
+        light_values = light_values[np.newaxis]
+
+    layer_lines, layer_units = [np.zeros((0, 4), dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for angle, lightest, offset in layers:
+        lines, units = clip_layer(light_values <= lightest, angle, spacing, offset, max_gap, min_length)
+        layer_lines.append(lines)
+        layer_units.append(units)
+
+    # every unit's lines together (a stable sort keeps each unit's layers in order)
+    units = np.concatenate(layer_units)
+    order = np.argsort(units, kind="stable")
+    return LineSet.from_counts(np.concatenate(layer_lines)[order], np.bincount(units, minlength=len(light_values)))
+
+################### PARALLEL HATCHING
+# every unit is hatched independently, so big murals can be split into chunks
+# of units and spread across a process pool ('Pool.map' keeps the chunks in order)
+
+def _hatch_chunk(job):
+    """Process pool worker: hatch one chunk of units (must be top-level so it can be pickled)"""
+    engine, white_cap, chunk = job
+    return HATCH_ENGINES[engine](chunk, white_cap)
+
+def hatch_units_parallel(brightness_arrays, engine=hatch_engine, white_cap=white_cap,
+                         workers=hatch_workers, chunk_size=hatch_chunk_size):
+    """Hatch units across a process pool and return their lines in the original unit order"""
+    if chunk_size < 1:
+        raise ValueError(f"Hatch chunk size must be at least 1 unit (got {chunk_size})")
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunks = [brightness_arrays[i:i + chunk_size] for i in range(0, len(brightness_arrays), chunk_size)]
+    workers = min(workers, len(chunks))
+
+    with Pool(processes=workers) as pool:
+        chunk_lines = pool.map(_hatch_chunk, [(engine, white_cap, chunk) for chunk in chunks])
+
+    return LineSet.concatenate(chunk_lines)
+
 ################### MAIN CLASS
 
 class HatchingSet:
     """Represents a list of all lines to draw (created in 'main.py' file)"""
 
-    def __init__(self, brightness_arrays):
+    def __init__(self, brightness_arrays, engine=hatch_engine, white_cap=white_cap,
+                 workers=hatch_workers, chunk_size=hatch_chunk_size):
         # number of units wide and high the image will be (from settings.py)
         self.WIDTH = units_wide
         self.HEIGHT = units_wide
@@ -94,19 +347,40 @@ class HatchingSet:
         # list of all unit brightness values (list of arrays)
         self.brightness_arrays = brightness_arrays
 
-        # this will hold all the points of lines divided by unit in a hellish
-        # series of lists of lists of lists: [[[x1, y1, x2, y2], ...], ...].
-        # in other words, at the smallest scale is a set of 2 points representing a line in the format
-        # [x1, y1, x2, y2]. At the next level, it's a list of lines. At the highest, it's a list of units.
-        self.total_lines = []
+        # 'python' hatches pixel by pixel with 'NewUnit', 'numpy' hatches all units at once
+        if engine not in HATCH_ENGINES:
+            raise ValueError(f"Unknown hatch engine '{engine}' (expected one of {list(HATCH_ENGINES)})")
+        self.engine = engine
+
+        # highest brightness value before a pixel is left white
+        self.white_cap = white_cap
+
+        # process pool settings (1 worker hatches serially)
+        if chunk_size < 1:
+            raise ValueError(f"Hatch chunk size must be at least 1 unit (got {chunk_size})")
+        self.workers = workers
+        self.chunk_size = chunk_size
+
+        # this will hold all the points of lines divided by unit as a 'LineSet' (see 'Line_Set.py'):
+        # every line is a row [x1, y1, x2, y2] of one array, and 'self.total_lines[i]' is unit i's lines.
+        # ('LineSet.to_nested()' gives the old lists of lists of lists: [[[x1, y1, x2, y2], ...], ...])
+        self.total_lines = LineSet()
 
     def create_hatching_set(self):
         """Main func"""
-        # loop through all units
-        for i, unit in enumerate(self.brightness_arrays):
-            new_unit = NewUnit(self.brightness_arrays[i])
-            new_unit.hatch_note()
-            self.total_lines.append(new_unit.linesToPrint)
+        units = list(self.brightness_arrays)
+        if not units:
+            return self.total_lines
+
+        # small grids (and engines that are fast anyway) are hatched serially since starting a pool
+        # costs more than it saves
+        min_units = hatch_parallel_min_units.get(self.engine)
+        with metrics.stage("hatching"):
+            if self.workers != 1 and min_units is not None and len(units) >= min_units:
+                self.total_lines = hatch_units_parallel(units, self.engine, self.white_cap,
+                                                        self.workers, self.chunk_size)
+            else:
+                self.total_lines = HATCH_ENGINES[self.engine](units, self.white_cap)
 
         return self.total_lines
 
@@ -115,20 +389,20 @@ class HatchingSet:
 class NewUnit:
     """All of the lines for one sticky note (a 'unit')"""
 
-    def __init__(self, unit_brightness_array):
+    def __init__(self, unit_brightness_array, white_cap=white_cap):
         # array of pixels
         self.raw_brightness_array = unit_brightness_array
-        self.brightness_array = self.map_brightness_values(self.raw_brightness_array)
+        self.brightness_array = self.map_brightness_values(self.raw_brightness_array, white_cap)
 
         # start of a new line when adding to 'linesToPrint'
         self.newx = 0
         self.newy = 0
         self.drawing_new_line = False
 
-        # list of all points in a line. Used for logic to draw or skip a line.
-        # is in the order of [[x1, y1], [x2, y2], ...], so that at any point,
-        # the point can be looked up as 'if [xn, yn] in covered_points: ...'
-        self.covered_points = []
+        # bitmap of all points covered by a line. Used for logic to draw or skip a line.
+        # it's shaped like the unit (indexed [y, x]), so that at any point the
+        # point can be looked up in constant time as 'if covered_points[yn, xn]: ...'
+        self.covered_points = np.zeros((pixels_per_unit_y, pixels_per_unit_x), dtype=bool)
 
         # this holds a series of 4 item lists, each being the coords of
         # a line to turn into g-code. It will hold all of this unit's lines
@@ -147,7 +421,7 @@ class NewUnit:
                     # darkest
                     case 1:
                         # always draw a line
-                        self.covered_points.append(curr_pos)
+                        self.covered_points[y, x] = True
                         self.end_or_start_line(True, curr_pos)
                     # if not darkest val, decide if draw line
                     case 2:
@@ -183,23 +457,6 @@ class NewUnit:
         self.linesToPrint.append([self.newx, self.newy, pos[0], pos[1]])
         self.drawing_new_line = False
 
-    def map_brightness_values(self, brightness_array):
+    def map_brightness_values(self, brightness_array, white_cap=white_cap):
         # 6 brightest (white), 1 darkest
-        new_brightness_array = brightness_array
-
-        # convert whole array at once
-        for y in range(pixels_per_unit_y):
-            for x in range(pixels_per_unit_x):
-                light_val = brightness_array[y][x]
-                # if pixel should be white
-                if light_val >= white_cap:
-                    new_brightness_array[y][x] = 6
-                else:
-                    # map remaining values onto a light value 1-5
-                    remaining_range = white_cap / 5
-                    for i in range(1, 6):
-                        if light_val <= (i * remaining_range):
-                            new_brightness_array[y][x] = i
-                            break
-
-        return new_brightness_array
\ No newline at end of file
+        return map_brightness_values(brightness_array, white_cap)
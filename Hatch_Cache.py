@@ -0,0 +1,157 @@
+"""
+#############################################################
+SUMMARY: Loading, resizing and hatching an image takes a while
+and gives the same result every time for the same image and
+settings. This script keeps those results on disk, keyed by a
+hash of the image file plus every setting that changes them,
+so a restarted job (after a crash or a printer reconnect) can
+skip straight to the preview and printing. The cache folder
+is kept under a size limit by deleting the least recently
+used results first.
+#############################################################
+"""
+
+from Univ_Settings import *
+
+from Image_Generator import calculate_brightness_arrays
+from Hatch_Algorithm import HatchingSet
+from Line_Set import LineSet
+import numpy as np
+import hashlib
+import json
+import os
+import tempfile
+
+# bump this if the format of a cache file (or the hatching output) changes
+CACHE_VERSION = 2
+
+def engine_settings(engine):
+    """Return the settings (besides 'white_cap') that change what a hatching engine draws"""
+    if engine == "crosshatch":
+        return {
+            "crosshatch_spacing": crosshatch_spacing,
+            "crosshatch_max_gap": crosshatch_max_gap,
+            "crosshatch_min_length": crosshatch_min_length,
+        }
+    return {}
+
+# hits/misses/evictions since the program started (for reporting)
+cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+def file_hash(path, block_size=1 << 20):
+    """Return the sha256 of a file's contents"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def cache_key(image_path, dimensions, white_cap, deadspace, engine=hatch_engine):
+    """Return the key for an image and the settings that change its hatching"""
+    settings = {
+        "version": CACHE_VERSION,
+        "image": file_hash(image_path),
+        "units_wide": dimensions[0],
+        "units_high": dimensions[1],
+        "white_cap": white_cap,
+        "pixels_of_deadspace": deadspace,
+        "pixels_per_unit_x": pixels_per_unit_x,
+        "pixels_per_unit_y": pixels_per_unit_y,
+        "fast_image_loading": fast_image_loading,
+        "image_prescale_margin": image_prescale_margin,
+        "hatch_engine": engine,
+        "engine_settings": engine_settings(engine),
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+def load_cached_hatching(key, cache_dir=hatch_cache_dir):
+    """Return (brightness_arrays, total_lines) stored under 'key', or None if it isn't cached"""
+    path = os.path.join(cache_dir, key + ".npz")
+    try:
+        with np.load(path) as data:
+            units = data["units"]
+            total_lines = LineSet.from_counts(data["lines"], data["line_counts"])
+    except (FileNotFoundError, OSError, KeyError, ValueError):
+        return None
+
+    # mark as recently used so it's the last to be evicted (unless another process just evicted it)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return units, total_lines
+
+def store_cached_hatching(key, brightness_arrays, total_lines, cache_dir=hatch_cache_dir,
+                          max_bytes=hatch_cache_max_bytes):
+    """Save brightness arrays and hatched lines under 'key' and keep the cache under 'max_bytes'"""
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # every unit's lines are saved as one (n, 4) array, with the number of lines per unit to split them back up
+    total_lines = LineSet.coerce(total_lines)
+
+    # write to a temp file first so a crash never leaves a half-written entry behind (every write gets
+    # its own temp file, since batch jobs in other processes can be storing the same key at once)
+    path = os.path.join(cache_dir, key + ".npz")
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".tmp", delete=False) as f:
+        np.savez(f, units=np.asarray(brightness_arrays, dtype=np.uint8), lines=total_lines.lines,
+                 line_counts=total_lines.line_counts())
+    os.replace(f.name, path)
+
+    evict_cache(cache_dir, max_bytes, keep=path)
+
+def evict_cache(cache_dir=hatch_cache_dir, max_bytes=hatch_cache_max_bytes, keep=None):
+    """Delete the least recently used entries until the cache is at most 'max_bytes'"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".npz"):
+            path = os.path.join(cache_dir, name)
+            # (another process can evict an entry at any point)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(entry[1] for entry in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            cache_stats["evictions"] += 1
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+def cached_hatching_set(image_path=image_path, dimensions=(units_wide, units_high), white_cap=white_cap,
+                        deadspace=pixels_of_deadspace, cache_dir=hatch_cache_dir, max_bytes=hatch_cache_max_bytes,
+                        show_image=True, workers=hatch_workers, engine=hatch_engine):
+    """Return (brightness_arrays, total_lines) for an image, from the cache if possible"""
+    try:
+        key = cache_key(image_path, dimensions, white_cap, deadspace, engine)
+    except FileNotFoundError:
+        print(f"No image at {image_path}")
+        quit()
+
+    cached = load_cached_hatching(key, cache_dir)
+    if cached is not None:
+        cache_stats["hits"] += 1
+        print(f"Hatch cache hit ({key[:12]}) - skipping image load and hatching. {cache_report()}")
+        return cached
+
+    cache_stats["misses"] += 1
+    print(f"Hatch cache miss ({key[:12]}) - hatching image. {cache_report()}")
+    brightness_arrays = calculate_brightness_arrays(image_path, dimensions, deadspace, show_image)
+    total_lines = HatchingSet(brightness_arrays, engine, white_cap, workers).create_hatching_set()
+    store_cached_hatching(key, brightness_arrays, total_lines, cache_dir, max_bytes)
+
+    return brightness_arrays, total_lines
+
+def cache_report():
+    """Return a one line summary of cache hits and misses"""
+    lookups = cache_stats["hits"] + cache_stats["misses"]
+    hit_rate = 100 * cache_stats["hits"] / lookups if lookups else 0
+    return (f"[hits: {cache_stats['hits']}, misses: {cache_stats['misses']}, "
+            f"evictions: {cache_stats['evictions']}, hit rate: {hit_rate:.0f}%]")
@@ -0,0 +1,183 @@
+"""
+#############################################################
+SUMMARY: Interactive tuning of 'white_cap' and
+'pixels_of_deadspace' for a new image, without editing
+'Univ_Settings.py' and rerunning everything each time.
+The image is loaded once and every resized version of it
+(one per deadspace) is kept, so changing a setting only
+re-maps the tones. Every unit's tone-mapped pixels are then
+hashed, and only units whose hash hasn't been hatched before
+are hatched again; the rest reuse their lines. Only the units
+that changed are redrawn in the preview, so each key press
+shows its result almost straight away.
+
+CONTROLS:
+    UP / DOWN       raise / lower white_cap
+    RIGHT / LEFT    more / less deadspace between units
+    R               reload the image (after editing it)
+    ENTER           print the settings to copy into 'Univ_Settings.py'
+
+USAGE:
+    python Hatch_Tuner.py [image path]
+#############################################################
+"""
+
+from Univ_Settings import *
+
+from Image_Generator import load_image, resize_and_crop, tile_units
+from Hatch_Algorithm import HATCH_ENGINES, map_brightness_values
+from Line_Set import LineSet
+from Preview_Renderer import preview_size, render_preview, redraw_units, unit_rect, preview_surface
+from PIL import Image
+import numpy as np
+import hashlib
+import time
+
+def unit_hashes(light_values):
+    """Return a hash of every unit's tone-mapped pixels (units with the same hash hatch the same)"""
+    return [hashlib.blake2b(unit.tobytes(), digest_size=16).digest() for unit in light_values]
+
+class HatchTuner:
+    """Keeps the hatching and preview of one image up to date as its settings change"""
+
+    def __init__(self, image_path=image_path, dimensions=(units_wide, units_high), white_cap=white_cap,
+                 deadspace=pixels_of_deadspace, engine=hatch_engine):
+        self.image_path = image_path
+        self.dimensions = tuple(dimensions)
+        self.white_cap = white_cap
+        self.deadspace = deadspace
+        self.engine = engine
+
+        # the grayscale image (unless it's loaded straight at the size needed, see 'fast_image_loading'),
+        # and its units (N, y, x) after resizing for each deadspace tried
+        self.img = None
+        self.resized_units = {}
+
+        # lines of every unit hatched so far, by the hash of its tone-mapped pixels
+        # (so going back to an earlier setting doesn't hatch anything)
+        self.lines_by_hash = {}
+
+        # current state: hash and lines of every unit, and the rendered preview
+        self.hashes = []
+        self.total_lines_set = LineSet()
+        self.canvas = None
+
+        self.reload_image()
+
+    def reload_image(self):
+        """Read the image again (after it's been edited). Returns the units that changed"""
+        if not fast_image_loading:
+            self.img = Image.open(self.image_path).convert('L')
+        self.resized_units.clear()
+        return self.update()
+
+    def units(self, deadspace):
+        """Raw brightness arrays of every unit for a deadspace (resized once per deadspace)"""
+        if deadspace not in self.resized_units:
+            if fast_image_loading:
+                img = load_image(self.image_path, self.dimensions, pixels_per_unit_x, pixels_per_unit_y, deadspace)
+            else:
+                img = resize_and_crop(self.img, self.dimensions, pixels_per_unit_x, pixels_per_unit_y, deadspace)
+            self.resized_units[deadspace] = np.ascontiguousarray(
+                tile_units(np.asarray(img), self.dimensions, pixels_per_unit_x, pixels_per_unit_y, deadspace)
+            ).reshape(-1, pixels_per_unit_y, pixels_per_unit_x)
+        return self.resized_units[deadspace]
+
+    def update(self, white_cap=None, deadspace=None):
+        """Change settings and re-hatch and redraw only the units they changed. Returns those units"""
+        if white_cap is not None:
+            self.white_cap = white_cap
+        if deadspace is not None:
+            self.deadspace = deadspace
+
+        units = self.units(self.deadspace)
+        new_hashes = unit_hashes(map_brightness_values(units, self.white_cap))
+        if len(new_hashes) == len(self.hashes):
+            dirty = [i for i, (old, new) in enumerate(zip(self.hashes, new_hashes)) if old != new]
+        else:
+            dirty = list(range(len(new_hashes)))
+
+        # hatch (in one go) only units that haven't been seen before
+        unseen = sorted({new_hashes[i]: i for i in dirty if new_hashes[i] not in self.lines_by_hash}.values())
+        if unseen:
+            hatched = HATCH_ENGINES[self.engine](units[unseen], self.white_cap)
+            for i, lines in zip(unseen, hatched):
+                self.lines_by_hash[new_hashes[i]] = lines
+
+        self.hashes = new_hashes
+        self.total_lines_set = LineSet.from_units([self.lines_by_hash[unit_hash] for unit_hash in new_hashes])
+
+        # a new deadspace moves every unit, so the preview is drawn from scratch
+        size = preview_size(self.dimensions, self.deadspace)
+        if self.canvas is None or self.canvas.shape[:2] != size[::-1]:
+            self.canvas = render_preview(self.total_lines_set, self.dimensions, self.deadspace)
+        elif dirty:
+            redraw_units(self.canvas, self.total_lines_set, dirty, self.dimensions, self.deadspace)
+
+        self.num_hatched = len(unseen)
+        return dirty
+
+    def settings_text(self):
+        """The current settings, ready to paste into 'Univ_Settings.py'"""
+        return (f"units_wide = {self.dimensions[0]}\nunits_high = {self.dimensions[1]}\n"
+                f"white_cap = {self.white_cap}\npixels_of_deadspace = {self.deadspace}")
+
+################### PYGAME WINDOW
+
+def run_tuner(tuner):
+    """Show the preview and change the settings with the arrow keys until the window is closed"""
+    import pygame
+
+    pygame.init()
+    screen = pygame.display.set_mode(preview_image_dim)
+    screen.fill(preview_background_color)
+    screen.blit(preview_surface(tuner.canvas), (0, 0))
+    pygame.display.flip()
+
+    while True:
+        event = pygame.event.wait()
+        if event.type == pygame.QUIT:
+            break
+        if event.type != pygame.KEYDOWN:
+            continue
+
+        old_size = tuner.canvas.shape
+        start = time.perf_counter()
+        if event.key == pygame.K_UP:
+            dirty = tuner.update(white_cap=min(tuner.white_cap + tuner_white_cap_step, 256))
+        elif event.key == pygame.K_DOWN:
+            dirty = tuner.update(white_cap=max(tuner.white_cap - tuner_white_cap_step, 1))
+        elif event.key == pygame.K_RIGHT:
+            dirty = tuner.update(deadspace=tuner.deadspace + 1)
+        elif event.key == pygame.K_LEFT:
+            dirty = tuner.update(deadspace=max(tuner.deadspace - 1, 0))
+        elif event.key == pygame.K_r:
+            dirty = tuner.reload_image()
+        elif event.key == pygame.K_RETURN:
+            print(tuner.settings_text())
+            continue
+        else:
+            continue
+        print(f"white_cap: {tuner.white_cap}, deadspace: {tuner.deadspace} - {len(dirty)} units changed, "
+              f"{tuner.num_hatched} hatched ({(time.perf_counter() - start) * 1000:.0f}ms)")
+
+        # only the changed units are sent to the window, unless the whole layout moved
+        if tuner.canvas.shape != old_size:
+            screen.fill(preview_background_color)
+            screen.blit(preview_surface(tuner.canvas), (0, 0))
+            pygame.display.flip()
+        elif dirty:
+            rects = []
+            for u_idx in dirty:
+                x, y, width, height = unit_rect(u_idx, tuner.dimensions, tuner.deadspace)
+                screen.blit(preview_surface(tuner.canvas[y:y + height, x:x + width]), (x, y))
+                rects.append(pygame.Rect(x, y, width, height))
+            pygame.display.update(rects)
+
+    pygame.quit()
+    print(tuner.settings_text())
+
+if __name__ == '__main__':
+    import sys
+
+    run_tuner(HatchTuner(sys.argv[1] if len(sys.argv) > 1 else image_path))
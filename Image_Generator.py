@@ -13,8 +13,10 @@ will convert the pixels into a hatching pattern for printing.
 
 from Univ_Settings import *
 
+from Metrics import metrics
 from PIL import Image
 import numpy as np
+import math
 
 # consts inherited from 'Univ_Settings.py'
 IMAGE_PATH = image_path
@@ -28,46 +30,58 @@ unit_deadspace = pixels_of_deadspace  # number of pixels in between sticky notes
 # list of all units (as arrays of brightness)
 all_units = []
 
-def calculate_brightness_arrays():
+def calculate_brightness_arrays(image_path=IMAGE_PATH, dimensions=total_dimensions, deadspace=unit_deadspace,
+                                show_image=True):
     # load image
     try:
-        img_raw = Image.open(IMAGE_PATH)
-        img = img_raw.convert('L')      # grayscale
+        if fast_image_loading:
+            # load straight at the size needed (grayscale, resized and cropped)
+            with metrics.stage("image_load"):
+                img = load_image(image_path, dimensions, UNIT_WIDTH, UNIT_HEIGHT, deadspace)
+        else:
+            with metrics.stage("image_load"):
+                img_raw = Image.open(image_path)
+                img = img_raw.convert('L')      # grayscale
     except FileNotFoundError:
-        print(f"No image at {IMAGE_PATH}")
+        print(f"No image at {image_path}")
         quit()
 
     # resize
-    img = resize_and_crop(img, total_dimensions, UNIT_WIDTH, UNIT_HEIGHT, unit_deadspace)
-
-    # analyze brightness and store as array per unit
-    curr_x, curr_y = 0, 0
-    for y in range(total_dimensions[1]):
-        for x in range(total_dimensions[0]):
-            # get array using 'analyze_brightness' func
-            new_unit = analyze_brightness(img, curr_x, curr_y, UNIT_WIDTH, UNIT_HEIGHT)
-            all_units.append(new_unit)
-            # create next starting point
-            curr_x += UNIT_WIDTH + unit_deadspace
-        curr_y += UNIT_HEIGHT + unit_deadspace
-        curr_x = 0
+    if not fast_image_loading:
+        with metrics.stage("resize"):
+            img = resize_and_crop(img, dimensions, UNIT_WIDTH, UNIT_HEIGHT, deadspace)
+
+    with metrics.stage("tiling"):
+        # convert the image to an array once and lay every unit out as a view into it
+        unit_grid = tile_units(np.asarray(img), dimensions, UNIT_WIDTH, UNIT_HEIGHT, deadspace)
+
+        # copy the units (minus the deadspace) into one contiguous block, ordered top left to bottom right
+        # (access a unit's pixels like: if units[i][y, x] < 255: ...)
+        units = np.ascontiguousarray(unit_grid).reshape(-1, UNIT_HEIGHT, UNIT_WIDTH)
+    all_units.clear()
+    all_units.extend(units)
 
     ######################## TEMP CODE for testing
     # print_ascii_representation(49)
     # print_ascii_representation()
-    display_image(img)
+    if show_image:
+        display_image(img)
 
     # func called by 'main.py'
-    return all_units
+    return units
 
-def resize_and_crop(img_obj, print_dimensions, u_width, u_height, deadspace):
-    """Shape image to desired size and crop excess"""
-    # Find width and height in pixels
+def print_size(print_dimensions, u_width, u_height, deadspace):
+    """Width and height in pixels of the whole print (units plus the deadspace between them)"""
     len_x = u_width * print_dimensions[0]
     len_x += (print_dimensions[0] - 1) * deadspace
     len_y = u_height * print_dimensions[1]
     len_y += (print_dimensions[1] - 1) * deadspace
-    target_size = (len_x, len_y)
+    return len_x, len_y
+
+def resize_and_crop(img_obj, print_dimensions, u_width, u_height, deadspace):
+    """Shape image to desired size and crop excess"""
+    # Find width and height in pixels
+    target_size = print_size(print_dimensions, u_width, u_height, deadspace)
 
     # find the larger scale factor
     og_w, og_h = img_obj.size
@@ -80,27 +94,81 @@ def resize_and_crop(img_obj, print_dimensions, u_width, u_height, deadspace):
     scaled_h = int(og_h * scale_factor)
     new_img = img_obj.resize((scaled_w, scaled_h), Image.Resampling.LANCZOS)
 
-    # calculate the crop (needs to be centered)
-    crop_box = (
-    int((scaled_w - target_size[0]) / 2),
-    int((scaled_h - target_size[1]) / 2),
-    int((scaled_w + target_size[0]) / 2),
-    int((scaled_h + target_size[1]) / 2)
-    )
+    # calculate the crop (needs to be centered, and exactly the target size: the scaled size is rounded
+    # down, so it can come up a pixel short, and that pixel is filled with black by the crop)
+    left = int((scaled_w - target_size[0]) / 2)
+    top = int((scaled_h - target_size[1]) / 2)
+    crop_box = (left, top, left + target_size[0], top + target_size[1])
     new_img = new_img.crop(crop_box)
 
     # return final image
     return new_img
 
-def analyze_brightness(img, x_start, y_start, u_width, u_height):
-    """Return an array representing the brightness values for the unit"""
-    # take the clip of the image that will go on this unit only
-    img_piece = img.crop((x_start, y_start, x_start + u_width, y_start + u_height))
-    pixel_data = list(img_piece.getdata())
-    new_unit_array = np.array(pixel_data).reshape((u_height, u_width))
-
-    # return array of brightness vals (access like: if new_unit_array(y, x) < 255: ...)
-    return new_unit_array
+def _inside(box, size):
+    """Clamp a (left, top, right, bottom) box to an image's size (rounding can push it just outside)"""
+    return [min(max(coord, 0), limit) for coord, limit in zip(box, size * 2)]
+
+def load_image(image_path, print_dimensions, u_width, u_height, deadspace, max_bytes=image_load_max_bytes,
+               margin=image_prescale_margin):
+    """Open an image as grayscale at the size of the print, centred and cropped like 'resize_and_crop',
+    without decoding or resampling more of it than needed"""
+    target_size = print_size(print_dimensions, u_width, u_height, deadspace)
+    img = Image.open(image_path)
+    og_w, og_h = img.size
+
+    # the centred part of the image that fills the print (in the image's pixels)
+    scale_factor = max(target_size[0] / og_w, target_size[1] / og_h)
+    crop_w, crop_h = target_size[0] / scale_factor, target_size[1] / scale_factor
+    crop_box = [(og_w - crop_w) / 2, (og_h - crop_h) / 2, (og_w + crop_w) / 2, (og_h + crop_h) / 2]
+
+    # JPEGs can be decoded straight to grayscale at a fraction of their size
+    # (the decoder picks the smallest scale that's still at least the size asked for)
+    img.draft('L', (math.ceil(og_w * scale_factor * margin), math.ceil(og_h * scale_factor * margin)))
+    if img.size != (og_w, og_h):
+        crop_box = [coord * img.size[0] / og_w for coord in crop_box]
+    crop_box = _inside(crop_box, img.size)
+
+    # refuse to decode anything that won't fit in the memory budget (the image plus a grayscale copy)
+    decoded_bytes = img.size[0] * img.size[1] * (len(img.getbands()) + (img.mode != 'L'))
+    if decoded_bytes > max_bytes:
+        raise MemoryError(f"Decoding {image_path} ({img.size[0]}x{img.size[1]} {img.mode}) needs about "
+                          f"{decoded_bytes / 2**20:.0f}MB, over the {max_bytes / 2**20:.0f}MB budget "
+                          f"('image_load_max_bytes')")
+    if img.mode != 'L':
+        img = img.convert('L')      # grayscale
+
+    # shrink the part that's used by a whole factor (averaging blocks of pixels), leaving
+    # at least 'margin' times the final size for the LANCZOS resize
+    reduce_factor = int(min((crop_box[2] - crop_box[0]) / target_size[0],
+                            (crop_box[3] - crop_box[1]) / target_size[1]) // margin)
+    if reduce_factor >= 2:
+        # (reduce needs a box in whole pixels, so the rest of the crop is left for the resize)
+        reduce_box = (int(crop_box[0]), int(crop_box[1]), math.ceil(crop_box[2]), math.ceil(crop_box[3]))
+        img = img.reduce(reduce_factor, box=reduce_box)
+        crop_box = _inside([(crop_box[0] - reduce_box[0]) / reduce_factor, (crop_box[1] - reduce_box[1]) / reduce_factor,
+                            (crop_box[2] - reduce_box[0]) / reduce_factor, (crop_box[3] - reduce_box[1]) / reduce_factor],
+                           img.size)
+
+    return img.resize(target_size, Image.Resampling.LANCZOS, box=crop_box)
+
+def tile_units(img_array, print_dimensions, u_width, u_height, deadspace):
+    """Return a read-only (units_high, units_wide, u_height, u_width) view of every unit in the image
+    array, skipping the deadspace between them (no pixels are copied)"""
+    # (the view isn't bounds checked, so a smaller array would have units reading past its end)
+    needed = print_size(print_dimensions, u_width, u_height, deadspace)
+    assert img_array.shape[0] >= needed[1] and img_array.shape[1] >= needed[0], \
+        f"image array is {img_array.shape[1]}x{img_array.shape[0]}, smaller than the print ({needed[0]}x{needed[1]})"
+
+    row_stride, col_stride = img_array.strides
+    unit_pitch_x = u_width + deadspace      # distance from one unit to the next
+    unit_pitch_y = u_height + deadspace
+
+    return np.lib.stride_tricks.as_strided(
+        img_array,
+        shape=(print_dimensions[1], print_dimensions[0], u_height, u_width),
+        strides=(unit_pitch_y * row_stride, unit_pitch_x * col_stride, row_stride, col_stride),
+        writeable=False
+    )
 
 def print_ascii_representation(unit=None):
     """This is a test function that prints out the image as an ASCII art conversion, using numbers, letters,
@@ -1,67 +1,64 @@
 """
 #############################################################
 SUMMARY: This file controls the printer directly. It prints
-each set of 2x2 units from the 'G-Code Converter' and waits
+each bed load of units from the 'G-Code Converter' and waits
 for user input before beginning each print (so that new notes
 can be added onto the bed for printing).
 #############################################################
 """
 import sys
-import math
+import atexit
 import pygame
 
 from Image_Generator import calculate_brightness_arrays
 from Hatch_Algorithm import HatchingSet
+from Hatch_Cache import cached_hatching_set
 from Unit_Reorderer import *
 from GCode_Controller import *
+from Print_Simulator import simulate_gcode, format_estimate
+from Preview_Renderer import render_preview, preview_surface
+from Print_Pipeline import PrintPipeline
+from Metrics import export_job_metrics
 
 class LinearPrinter:
     """Main program class - runs all other files"""
 
     def __init__(self):
         """Start pygame window"""
-        self.new_brightness_array = calculate_brightness_arrays()
-        self.new_hatching_array = HatchingSet(self.new_brightness_array)
-        self.new_total_lines_set = self.new_hatching_array.create_hatching_set()
-
-        # for line-rendering readability
-        self.x1 = 0
-        self.y1 = 0
-        self.x2 = 0
-        self.y2 = 0
-        self.x_offset = 0
-        self.y_offset = 0
-        self.u_idx = 0      # unit index
+        self.pipeline = None
+        if use_print_pipeline:
+            # work out the unit groups one at a time in the background, starting now
+            self.pipeline = PrintPipeline()
+            self.new_total_lines_set = None
+        elif use_hatch_cache:
+            # reuse the hatching from a previous run of the same image and settings if there is one
+            self.new_brightness_array, self.new_total_lines_set = cached_hatching_set()
+        else:
+            self.new_brightness_array = calculate_brightness_arrays()
+            self.new_hatching_array = HatchingSet(self.new_brightness_array)
+            self.new_total_lines_set = self.new_hatching_array.create_hatching_set()
+
         self.y_unit_group_displacement = units_high * (pixels_per_unit_y + pixels_of_deadspace)     # space btwn each unit group
 
         self.drawn_preview = False
 
     def create_hatching_preview(self, screen, lines_set):
         """Display entire image in hatching style in the pygame window"""
-        # preview hatching pattern
-        for y in range(units_high):
-            self.y_offset = y * (pixels_per_unit_y + pixels_of_deadspace)
-            for x in range(units_wide):
-                self.x_offset = x * (pixels_per_unit_x + pixels_of_deadspace)
-                for line in lines_set[self.u_idx]:
-                    # local to global coords
-                    self.x1 = line[0] + self.x_offset
-                    self.y1 = line[1] + self.y_offset
-                    self.x2 = line[2] + self.x_offset
-                    self.y2 = line[3] + self.y_offset
+        # the whole preview is rendered at once and drawn as one image, so it can be redrawn at any time
+        screen.blit(preview_surface(render_preview(lines_set)), (0, 0))
 
-                    # render
-                    pygame.draw.line(screen,
-                                     preview_line_color,
-                                     (self.x1, self.y1),
-                                     (self.x2, self.y2))
-                self.u_idx += 1
+    def hatch_whole_image(self):
+        """Hatch every unit up front (for single note prints when the groups are being pipelined)"""
+        if self.new_total_lines_set is None:
+            self.pipeline.close()
+            self.new_brightness_array, self.new_total_lines_set = cached_hatching_set(show_image=False)
+        return self.new_total_lines_set
 
     def create_printing_layout_preview(self, screen, lines_set):
-        """Display the order of printing with the image reordered into groups of 2x2 units"""
-        # preview unlaid units using reorder script (2x2 layout)
+        """Display the order of printing with the image reordered into bed loads of units"""
+        # preview unlaid units using reorder script (bed layout)
         for unit_group in lines_set:
-            self.y_unit_group_displacement += 2 * (pixels_per_unit_y + pixels_of_deadspace)
+            self.y_unit_group_displacement += bed_units_y * (pixels_per_unit_y + pixels_of_deadspace)
             for unit in unit_group:
                 for line in unit:
                     # render
@@ -79,6 +76,10 @@ class LinearPrinter:
 
 
 if __name__ == '__main__':
+    # save this job's timings and counters however the program ends
+    if collect_metrics:
+        atexit.register(export_job_metrics)
+
     lp = LinearPrinter()
     total_lines_set = lp.new_total_lines_set
 
@@ -89,6 +90,8 @@ if __name__ == '__main__':
     screen.fill((255, 255, 255))
 
     displayed_preview = False
+    shown_preview_version = 0
+    reordered_total_lines_set = None
     begun_printing = False
     redo_this_print = False
     start_button_counter_set = 5000
@@ -109,10 +112,14 @@ if __name__ == '__main__':
         else:
             start_button_counter = start_button_counter_set
 
-        # preview before printing
-        if not displayed_preview:
+        # preview before printing (when pipelining, it fills in as groups are hatched)
+        if lp.pipeline is not None:
+            if lp.pipeline.preview_version != shown_preview_version:
+                shown_preview_version = lp.pipeline.preview_version
+                screen.blit(preview_surface(lp.pipeline.preview_snapshot()), (0, 0))
+        elif not displayed_preview:
             lp.create_hatching_preview(screen, total_lines_set)
-            reordered_total_lines_set = reorder_units_groups_of_four(total_lines_set)
+            reordered_total_lines_set = reorder_units_into_groups(total_lines_set)
             #lp.create_printing_layout_preview(screen, reordered_total_lines_set)
             displayed_preview = True
 
@@ -124,7 +131,13 @@ if __name__ == '__main__':
 
         # printing logic and printer control
         if begun_printing:
-            raw_reordered_total_lines = get_raw_converted_total_lines(reordered_total_lines_set)
+            if lp.pipeline is not None:
+                # groups are taken from the background thread as they're needed
+                group_jobs = iter(lp.pipeline)
+                num_groups = lp.pipeline.num_groups
+            else:
+                raw_reordered_total_lines = get_raw_converted_total_lines(reordered_total_lines_set)
+                num_groups = len(raw_reordered_total_lines)
 
             # main printing code to control printer
             printer = establish_printer_connection(printer_port, baud_rate)
@@ -140,18 +153,33 @@ if __name__ == '__main__':
 
             if new_input == "yes" or new_input == "y":
                 # begin sending g-code commands to the printer
-                for i, new_print in enumerate(raw_reordered_total_lines):
+                group_units = group_unit_indices()
+                for i in range(num_groups):
+                    if lp.pipeline is not None:
+                        # (waits here if the background thread hasn't finished this group yet)
+                        job = next(group_jobs)
+                        new_print, estimate = job.lines, job.estimate
+                    else:
+                        new_print = raw_reordered_total_lines[i]
+                        estimate = simulate_gcode(generate_gcode(new_print))
+
+                    # which notes go on the bed (numbered like the single note prints, laid out like the mural)
+                    notes = [" ".join(f"{unit + 1:>3}" if unit >= 0 else "  -" for unit in row)
+                             for row in group_units[i].reshape(bed_units_y, bed_units_x)]
+                    print(f"Unit group {i + 1}/{num_groups}, notes:\n" + "\n".join(notes))
                     new_input = input("Press enter to continue... (type 'skip' to skip or a number to print just one note)").lower()
                     if new_input == "skip":
                         continue
 
-                    # get g-code commands for this group of units
-                    new_gcode_cmds = convert_to_gcode(new_print)
+                    print(f"Estimated print time for this group: {format_estimate(estimate)}")
                     response = "redo-print"
 
                     while response == "redo-print":
-                        # print
-                        print_unit_group(printer, new_gcode_cmds)
+                        # get g-code commands for this group of units and print
+                        if lp.pipeline is not None:
+                            print_unit_group(printer, job.gcode)
+                        else:
+                            print_unit_group(printer, generate_gcode(new_print, group=i))
 
                         # each iteration of this loop is a full print, which can take 20 minutes-ish,
                         # so handle user input directly through terminal
@@ -159,7 +187,7 @@ if __name__ == '__main__':
                             pass
 
                         response = ""
-                        if i == len(raw_reordered_total_lines) - 1:
+                        if i == num_groups - 1:
                             while response not in ["finish", "redo-print"]:
                                 response = input(
                                     '---- What would you like to do next? ("finish", "redo-print") ---- ').lower()
@@ -173,6 +201,8 @@ if __name__ == '__main__':
                             print('\n'*5)
                             print("*DING* Your print is ready. Yay!")
             else:
+                if reordered_total_lines_set is None:
+                    reordered_total_lines_set = reorder_units_into_groups(lp.hatch_whole_image())
                 finished = False
                 while not finished:
                     # print just one specific note
@@ -186,11 +216,10 @@ if __name__ == '__main__':
                                 unit_num = -1
                                 print(f"That number is out of range. The range is 1 to {units_high * units_wide}")
                             else:
-                                # find the index of the unit
+                                # find which group the unit is in and where it sits on the bed
                                 unit_num -= 1
-                                print_num = math.floor(unit_num / 4)
-                                unit_idx = unit_num - print_num * 4
-                                new_gcode_cmds = convert_to_gcode(reordered_total_lines_set[print_num][unit_idx])
+                                print_num, unit_idx = locate_unit(unit_num)
+                                new_gcode_cmds = generate_gcode(reordered_total_lines_set[print_num][unit_idx])
                                 print_unit_group(printer, new_gcode_cmds)
 
                         except ValueError:
@@ -0,0 +1,189 @@
+"""
+#############################################################
+SUMMARY: Opt-in instrumentation for the whole pipeline. When
+'collect_metrics' is on, every stage (image load, resize,
+tiling, tone mapping, hatching, reordering, g-code) records
+how long it took, every unit group records how many lines,
+Z cycles, commands and bytes it sent, and the printer link
+records how long each command waited for its 'ok' plus any
+timeouts and resends. Everything can be saved to a JSON or
+CSV file per job, which shows whether a slow print is down
+to the serial link, the firmware, or the hatching.
+#############################################################
+"""
+
+from Univ_Settings import *
+
+from collections import defaultdict
+import contextlib
+import functools
+import csv
+import datetime
+import json
+import os
+import time
+
+# upper edges (ms) of the command-to-'ok' latency histogram buckets (the last bucket is everything slower)
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+def _drops_pen(cmd_bytes):
+    """True if a command moves Z down to 'z_draw_level'. The value is compared as a number, since the
+    compact g-code writes it without trailing zeros ('Z97' for 97.0) and the plain g-code doesn't"""
+    for word in cmd_bytes.split(b';')[0].split():
+        if word[:1] in (b'Z', b'z'):
+            try:
+                return float(word[1:]) == z_draw_level
+            except ValueError:
+                return False
+    return False
+
+class PipelineMetrics:
+    """Timers and counters for one job"""
+
+    def __init__(self, enabled=collect_metrics):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        # seconds and number of runs per stage
+        self.stage_seconds = defaultdict(float)
+        self.stage_calls = defaultdict(int)
+
+        # counters per unit group (lines, z_cycles, commands, bytes)
+        self.group_counts = defaultdict(lambda: defaultdict(int))
+
+        # serial link
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.events = defaultdict(int)       # timeouts, resends
+
+    ################## RECORDING
+
+    def stage(self, name):
+        """Context manager that adds the time spent inside it to a stage"""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timed_stage(name)
+
+    @contextlib.contextmanager
+    def _timed_stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[name] += time.perf_counter() - start
+            self.stage_calls[name] += 1
+
+    def timed(self, name):
+        """Decorator that adds the time spent in a function to a stage"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, group, name, amount=1):
+        """Add to a unit group's counter"""
+        if self.enabled:
+            self.group_counts[group][name] += amount
+
+    def count_event(self, name, amount=1):
+        """Add to a printer link event counter (timeouts, resends)"""
+        if self.enabled:
+            self.events[name] += amount
+
+    def record_latency(self, seconds):
+        """Add a command-to-'ok' time to the latency histogram"""
+        if not self.enabled:
+            return
+        milliseconds = seconds * 1000
+        bucket = len(LATENCY_BUCKETS_MS)
+        for i, upper_edge in enumerate(LATENCY_BUCKETS_MS):
+            if milliseconds <= upper_edge:
+                bucket = i
+                break
+        self.latency_counts[bucket] += 1
+        self.latency_total += seconds
+        self.latency_max = max(self.latency_max, seconds)
+
+    def meter_gcode(self, gcode, group):
+        """Wrap a command stream so the time spent making it, and its commands, bytes and Z cycles
+        (pen drops) are counted against a unit group as it's used"""
+        if not self.enabled:
+            yield from gcode
+            return
+
+        commands = iter(gcode)
+        while True:
+            start = time.perf_counter()
+            cmd = next(commands, None)
+            self.stage_seconds["gcode_generation"] += time.perf_counter() - start
+            if cmd is None:
+                break
+            cmd_bytes = cmd.encode("utf-8") if isinstance(cmd, str) else cmd
+            self.count(group, "commands")
+            self.count(group, "bytes", len(cmd_bytes) + 1)
+            if _drops_pen(cmd_bytes):
+                self.count(group, "z_cycles")
+            yield cmd
+        self.stage_calls["gcode_generation"] += 1
+
+    ################## REPORTING
+
+    def summary(self):
+        """Return all metrics as a dict"""
+        num_latencies = sum(self.latency_counts)
+        bucket_names = [f"<={edge}ms" for edge in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        return {
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "stages": {name: {"seconds": seconds, "calls": self.stage_calls[name]}
+                       for name, seconds in self.stage_seconds.items()},
+            "groups": {str(group): dict(counts) for group, counts in sorted(self.group_counts.items())},
+            "serial": {
+                "commands_acknowledged": num_latencies,
+                "latency_mean_ms": 1000 * self.latency_total / num_latencies if num_latencies else 0,
+                "latency_max_ms": 1000 * self.latency_max,
+                "latency_histogram": dict(zip(bucket_names, self.latency_counts)),
+                **self.events,
+            },
+        }
+
+    def export(self, path):
+        """Save the metrics as JSON, or as CSV rows of (section, name, key, value) if 'path' ends in .csv"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        summary = self.summary()
+
+        if not path.lower().endswith(".csv"):
+            with open(path, "w") as f:
+                json.dump(summary, f, indent=2)
+            return path
+
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["section", "name", "key", "value"])
+            for name, values in summary["stages"].items():
+                for key, value in values.items():
+                    writer.writerow(["stage", name, key, value])
+            for group, counts in summary["groups"].items():
+                for key, value in counts.items():
+                    writer.writerow(["group", group, key, value])
+            for key, value in summary["serial"].items():
+                if key == "latency_histogram":
+                    for bucket, count in value.items():
+                        writer.writerow(["serial", "latency_histogram", bucket, count])
+                else:
+                    writer.writerow(["serial", "", key, value])
+        return path
+
+def export_job_metrics(path=None):
+    """Save this job's metrics (to a timestamped file in 'metrics_dir' if no path is given)"""
+    if path is None:
+        path = os.path.join(metrics_dir, f"job_{datetime.datetime.now():%Y%m%d_%H%M%S}.{metrics_format}")
+    print(f"Saved print metrics to {metrics.export(path)}")
+    return path
+
+# metrics for the job being run (shared by every stage)
+metrics = PipelineMetrics()
@@ -0,0 +1,178 @@
+"""
+#############################################################
+SUMMARY: Pipelined printing. Normally the whole image is
+hatched, reordered and converted before the first command
+reaches the printer. Here a background thread does all of
+that one unit group (bed load) at a time - cutting the group's
+units out of the image, hatching them, placing them on the
+bed, ordering the strokes and making the g-code - and hands
+each finished group over through a small queue. The first
+group can start printing as soon as it's ready, and later
+groups are worked out while earlier ones print and while the
+operator reloads the bed. The preview fills in as groups are
+hatched.
+
+USAGE:
+    python Print_Pipeline.py [image path]     (times the first group against the whole job, no printer)
+#############################################################
+"""
+
+from Univ_Settings import *
+
+from Image_Generator import load_image, resize_and_crop, tile_units
+from Hatch_Algorithm import HATCH_ENGINES
+from Unit_Reorderer import group_unit_indices, place_units_on_bed, order_group_lines
+from GCode_Controller import generate_gcode, group_end_gcode
+from Print_Simulator import simulate_gcode
+from Preview_Renderer import preview_size, redraw_units
+from Metrics import metrics
+from PIL import Image
+import numpy as np
+import queue
+import threading
+import time
+
+# put on the queue after the last group (or with the error that stopped the pipeline)
+_DONE = object()
+
+class GroupJob:
+    """Everything needed to print one unit group"""
+
+    __slots__ = ("index", "unit_indices", "lines", "gcode", "estimate")
+
+    def __init__(self, index, unit_indices, lines, gcode, estimate):
+        self.index = index                  # group number (from 0)
+        self.unit_indices = unit_indices    # mural unit in every spot on the bed (-1 for none)
+        self.lines = lines                  # (n, 4) array of lines in the order they're drawn
+        self.gcode = gcode                  # list of commands (reusable, e.g. to redo a print)
+        self.estimate = estimate            # print time estimate (see 'Print_Simulator.py')
+
+class PrintPipeline:
+    """Works out unit groups in a background thread. Iterate over it to get each GroupJob in order"""
+
+    def __init__(self, image_path=image_path, dimensions=(units_wide, units_high), white_cap=white_cap,
+                 deadspace=pixels_of_deadspace, layout=(bed_units_x, bed_units_y),
+                 prefetch=pipeline_prefetch_groups, engine=hatch_engine):
+        self.image_path = image_path
+        self.dimensions = tuple(dimensions)
+        self.white_cap = white_cap
+        self.deadspace = deadspace
+        self.layout = tuple(layout)
+        self.engine = engine
+
+        # which mural unit goes in each spot on the bed, for every group
+        self.unit_table = group_unit_indices(self.dimensions, self.layout)
+        self.num_groups = len(self.unit_table)
+
+        # finished groups wait here (at most 'prefetch' of them, so the thread doesn't run far ahead)
+        self.jobs = queue.Queue(maxsize=max(prefetch, 1))
+        self.stopping = threading.Event()
+
+        # the preview fills in as groups are hatched ('preview_version' goes up every time it changes)
+        width, height = preview_size(self.dimensions, self.deadspace)
+        self.preview = np.empty((height, width, 3), dtype=np.uint8)
+        self.preview[...] = preview_background_color
+        self.preview_version = 0
+        self.preview_lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    ################## BACKGROUND THREAD
+
+    def _load_unit_grid(self):
+        """(units_high, units_wide, y, x) view of every unit's raw brightness values"""
+        with metrics.stage("image_load"):
+            if fast_image_loading:
+                img = load_image(self.image_path, self.dimensions, pixels_per_unit_x, pixels_per_unit_y,
+                                 self.deadspace)
+            else:
+                img = resize_and_crop(Image.open(self.image_path).convert('L'), self.dimensions,
+                                      pixels_per_unit_x, pixels_per_unit_y, self.deadspace)
+        return tile_units(np.asarray(img), self.dimensions, pixels_per_unit_x, pixels_per_unit_y, self.deadspace)
+
+    def make_group(self, unit_grid, group_idx):
+        """Hatch, place, order and convert one unit group"""
+        unit_indices = self.unit_table[group_idx]
+        used = unit_indices[unit_indices >= 0]
+
+        # only this group's units are copied out of the image
+        brightness_arrays = unit_grid[used // self.dimensions[0], used % self.dimensions[0]]
+        with metrics.stage("hatching"):
+            hatched = HATCH_ENGINES[self.engine](brightness_arrays, self.white_cap)
+
+        # spots on the bed with no unit point at an empty unit after the hatched ones
+        spots = np.full(len(unit_indices), -1)
+        spots[unit_indices >= 0] = np.arange(len(used))
+        with metrics.stage("reordering"):
+            unit_group = place_units_on_bed(hatched, spots[np.newaxis], self.layout)[0]
+        with metrics.stage("stroke_ordering"):
+            lines = order_group_lines(unit_group)[0]
+        metrics.count(group_idx, "lines", len(lines))
+
+        gcode = list(generate_gcode(lines, group=group_idx))
+        estimate = simulate_gcode(gcode + [group_end_gcode()])
+        self._draw_preview(hatched, used)
+        return GroupJob(group_idx, unit_indices, lines, gcode, estimate)
+
+    def _draw_preview(self, hatched, used):
+        """Draw a group's units in their place in the preview"""
+        # every mural unit that isn't in this group points at an empty unit on the end
+        mural_units = np.full(self.dimensions[0] * self.dimensions[1], len(used))
+        mural_units[used] = np.arange(len(used))
+        mural_lines = hatched.padded(len(used) + 1).take(mural_units)
+        with self.preview_lock:
+            redraw_units(self.preview, mural_lines, used, self.dimensions, self.deadspace)
+            self.preview_version += 1
+
+    def _produce(self):
+        try:
+            unit_grid = self._load_unit_grid()
+            for group_idx in range(self.num_groups):
+                if not self._put(self.make_group(unit_grid, group_idx)):
+                    return
+            self._put(_DONE)
+        except Exception as e:
+            # hand the error over so it's raised where the groups are being printed
+            self._put((_DONE, e))
+
+    def _put(self, item):
+        """Wait for room on the queue (unless the pipeline is being stopped). Returns False if stopped"""
+        while not self.stopping.is_set():
+            try:
+                self.jobs.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    ################## PRINTING SIDE
+
+    def __iter__(self):
+        while True:
+            item = self.jobs.get()
+            if item is _DONE:
+                return
+            if isinstance(item, tuple) and item[0] is _DONE:
+                raise item[1]
+            yield item
+
+    def preview_snapshot(self):
+        """A copy of the preview as it is now"""
+        with self.preview_lock:
+            return self.preview.copy()
+
+    def close(self):
+        """Stop working out groups (any group being worked on is finished first)"""
+        self.stopping.set()
+        self.thread.join()
+
+if __name__ == '__main__':
+    import sys
+
+    start = time.perf_counter()
+    pipeline = PrintPipeline(sys.argv[1] if len(sys.argv) > 1 else image_path, prefetch=1)
+    for job in pipeline:
+        if job.index == 0:
+            print(f"First group ready after {time.perf_counter() - start:.2f}s")
+    print(f"All {pipeline.num_groups} groups ready after {time.perf_counter() - start:.2f}s")
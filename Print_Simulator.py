@@ -0,0 +1,153 @@
+"""
+#############################################################
+SUMMARY: This script estimates how long g-code will take to
+print without running the printer. It follows the commands
+the same way the firmware's motion planner does: every move
+speeds up and slows down at the axis accelerations, is capped
+by its feedrate and the axis max speeds, and only keeps speed
+through a corner as far as the junction deviation allows.
+The time is split into pen-down drawing, pen-up travel and Z
+(lift/drop) moves, per unit group and for the whole job, so
+ordering/stitching settings can be compared and print shifts
+planned without using machine time.
+
+USAGE:
+    python Print_Simulator.py      (compares stroke settings for the image in 'Univ_Settings.py')
+#############################################################
+"""
+
+from Univ_Settings import *
+
+from GCode_Controller import clean_command, generate_gcode, group_end_gcode
+import numpy as np
+import datetime
+
+AXES = "XYZ"
+
+def parse_moves(gcode, start=None):
+    """Return (positions (n + 1, 3), feedrates in mm/min (n,)) of every G0/G1 move in a command stream"""
+    if start is None:
+        # a unit group starts where the last one left the pen
+        start = [0.0, bed_units_y * pixels_per_unit_y, z_lift_level]
+    pos = [float(value) for value in start]
+    feedrate = travel_speed
+
+    positions = [list(pos)]
+    feedrates = []
+    for cmd in gcode:
+        words = clean_command(cmd).split()
+        if not words or words[0] not in (b"G0", b"G1"):
+            continue
+        for word in words[1:]:
+            letter = chr(word[0])
+            if letter in AXES:
+                pos[AXES.index(letter)] = float(word[1:])
+            elif letter == "F":
+                feedrate = float(word[1:])
+        positions.append(list(pos))
+        feedrates.append(feedrate)
+
+    return np.array(positions, dtype=np.float64).reshape(-1, 3), np.array(feedrates, dtype=np.float64)
+
+def _trapezoid_times(lengths, entry_speeds, exit_speeds, cruise_speeds, accels):
+    """Time for every move to go from its entry to its exit speed, cruising as fast as it can in between"""
+    accel_dist = (cruise_speeds ** 2 - entry_speeds ** 2) / (2 * accels)
+    decel_dist = (cruise_speeds ** 2 - exit_speeds ** 2) / (2 * accels)
+    reaches_cruise = accel_dist + decel_dist <= lengths
+
+    # moves too short to reach cruise speed peak somewhere in the middle instead
+    peak_speeds = np.where(reaches_cruise, cruise_speeds,
+                           np.sqrt((2 * accels * lengths + entry_speeds ** 2 + exit_speeds ** 2) / 2))
+    cruise_dist = np.where(reaches_cruise, lengths - accel_dist - decel_dist, 0)
+    return ((peak_speeds - entry_speeds) / accels + (peak_speeds - exit_speeds) / accels +
+            cruise_dist / np.maximum(peak_speeds, 1e-9))
+
+def simulate_moves(positions, feedrates):
+    """Return the time (seconds) of every move and whether it's a 'draw', 'travel' or 'z' move"""
+    deltas = np.diff(positions, axis=0)
+    lengths = np.linalg.norm(deltas, axis=1)
+    moving = lengths > 1e-9
+    deltas, lengths, feedrates = deltas[moving], lengths[moving], feedrates[moving]
+    start_z = positions[:-1, 2][moving]
+
+    kinds = np.full(len(lengths), "travel", dtype=object)
+    xy_lengths = np.linalg.norm(deltas[:, :2], axis=1)
+    kinds[xy_lengths <= 1e-9] = "z"
+    kinds[(xy_lengths > 1e-9) & (deltas[:, 2] == 0) & (start_z <= z_draw_level + 1e-6)] = "draw"
+    if len(lengths) == 0:
+        return np.zeros(0), kinds
+
+    # the speed and acceleration of a move are capped so no single axis goes over its limits
+    unit_vecs = deltas / lengths[:, np.newaxis]
+    axis_share = np.maximum(np.abs(unit_vecs), 1e-12)
+    cruise_speeds = np.minimum(feedrates / 60, np.min(np.array(sim_max_feedrates) / axis_share, axis=1))
+    accels = np.min(np.array(sim_max_accelerations) / axis_share, axis=1)
+
+    # junction deviation: the speed a corner can be taken at depends on how sharp it is
+    cos_theta = -np.einsum("ij,ij->i", unit_vecs[:-1], unit_vecs[1:])
+    sin_half_theta = np.sqrt(np.clip(0.5 * (1 - cos_theta), 0, 1))
+    with np.errstate(divide="ignore"):
+        junction_speeds = np.sqrt(np.minimum(accels[:-1], accels[1:]) * sim_junction_deviation *
+                                  sin_half_theta / (1 - sin_half_theta))
+    junction_speeds = np.minimum(junction_speeds, np.minimum(cruise_speeds[:-1], cruise_speeds[1:]))
+
+    # the machine starts and ends still. Then every move has to be able to slow down in time for
+    # the next junction (backward pass) and can only get as fast as it can accelerate (forward pass)
+    speeds = np.concatenate([[0.0], junction_speeds, [0.0]])
+    reach = 2 * accels * lengths
+    for i in range(len(lengths) - 1, 0, -1):
+        speeds[i] = min(speeds[i], np.sqrt(speeds[i + 1] ** 2 + reach[i]))
+    for i in range(len(lengths)):
+        speeds[i + 1] = min(speeds[i + 1], np.sqrt(speeds[i] ** 2 + reach[i]))
+
+    times = _trapezoid_times(lengths, speeds[:-1], speeds[1:], cruise_speeds, accels)
+    times[kinds == "z"] += sim_z_settle_time
+    return times, kinds
+
+def simulate_gcode(gcode, start=None):
+    """Estimate how long a command stream takes to print, split into drawing, travel and Z moves"""
+    times, kinds = simulate_moves(*parse_moves(gcode, start))
+    estimate = {kind: float(times[kinds == kind].sum()) for kind in ("draw", "travel", "z")}
+    estimate["total"] = float(times.sum())
+    estimate["moves"] = len(times)
+    estimate["z_moves"] = int(np.count_nonzero(kinds == "z"))
+    return estimate
+
+def estimate_job(raw_converted_total_lines):
+    """Estimate every unit group of a job. Returns (list of group estimates, job totals)"""
+    group_estimates = []
+    for raw_line_set in raw_converted_total_lines:
+        gcode = list(generate_gcode(raw_line_set)) + [group_end_gcode()]
+        group_estimates.append(simulate_gcode(gcode))
+
+    totals = {key: sum(estimate[key] for estimate in group_estimates)
+              for key in ("draw", "travel", "z", "total", "moves", "z_moves")}
+    return group_estimates, totals
+
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+def format_estimate(estimate):
+    """One line summary of an estimate"""
+    return (f"{format_duration(estimate['total'])} (drawing {format_duration(estimate['draw'])}, "
+            f"travel {format_duration(estimate['travel'])}, Z {format_duration(estimate['z'])}, "
+            f"{estimate['z_moves']} Z moves)")
+
+def compare_stroke_settings(total_lines_set, dimensions=(units_wide, units_high)):
+    """Print the job estimate for every stroke ordering, with and without stitching"""
+    # (imported here since the reorderer imports the stroke optimizer, which doesn't need this file)
+    from Unit_Reorderer import reorder_units_into_groups, get_raw_converted_total_lines
+    from Stroke_Optimizer import STROKE_ORDERS
+
+    for stitch in (False, True):
+        for order in STROKE_ORDERS:
+            groups = reorder_units_into_groups(total_lines_set, dimensions)
+            raw_converted_total_lines = get_raw_converted_total_lines(groups, order, stitch)
+            _, totals = estimate_job(raw_converted_total_lines)
+            print(f"---- order: {order:<10} stitching: {str(stitch):<5} -> {format_estimate(totals)}")
+
+if __name__ == '__main__':
+    from Hatch_Cache import cached_hatching_set
+
+    _, total_lines_set = cached_hatching_set()
+    compare_stroke_settings(total_lines_set)
@@ -0,0 +1,274 @@
+"""
+#############################################################
+SUMMARY: Prints one mural on several printers at once. Every
+unit group is its own bed load, so the groups don't have to
+go through one printer in order: they wait in a queue, and
+each printer (with its own connection and worker thread)
+takes the next group whenever it's free. If a printer drops
+out part way through a group, that group goes back in the
+queue for any printer and the dropped printer is reconnected
+(and given up on after 'farm_max_failures' failures in a
+row). The progress of every printer is kept as it goes.
+
+Like 'Main.py', the farm waits for the operator to put fresh
+notes on a printer's bed before every group it prints there
+(including a group sent back after a failure, which lands on
+a bed of half drawn notes). Only virtual printers should be
+run without that ('load_bed=None').
+
+Ports can be pyserial URLs as well as serial ports, so the
+farm can be tried out without printers, e.g. against
+'socket://localhost:5000' (see 'Virtual_Printer.py').
+
+USAGE:
+    python Printer_Farm.py [port ...]     (defaults to 'farm_ports', prints the image in 'Univ_Settings.py')
+#############################################################
+"""
+
+from Univ_Settings import *
+
+from GCode_Controller import establish_printer_connection, prepare_print, print_unit_group, generate_gcode
+import serial
+import queue
+import threading
+import time
+
+class PrinterStatus:
+    """Progress of one printer in the farm"""
+
+    __slots__ = ("port", "state", "group", "commands_sent", "commands_total", "groups_done", "failures",
+                 "failures_in_a_row", "busy_seconds", "last_error")
+
+    def __init__(self, port):
+        self.port = port
+        self.state = "waiting"          # waiting, connecting, idle, loading, printing, reconnecting, gave up, finished
+        self.group = None               # group being printed
+        self.commands_sent = 0          # of the group being printed
+        self.commands_total = 0
+        self.groups_done = 0
+        self.failures = 0
+        self.failures_in_a_row = 0
+        self.busy_seconds = 0.0         # time spent printing groups that finished
+        self.last_error = None
+
+    def __str__(self):
+        text = f"{self.port}: {self.state}"
+        if self.state == "printing":
+            text += f" group {self.group + 1} ({100 * self.commands_sent // max(self.commands_total, 1)}%)"
+        elif self.state == "loading":
+            text += f" group {self.group + 1} (waiting for the bed)"
+        text += f", {self.groups_done} groups done"
+        if self.failures:
+            text += f", failures: {self.failures} (last: {self.last_error})"
+        return text
+
+class PrinterFarm:
+    """Hands unit groups to whichever printer is free (one worker thread per printer)"""
+
+    def __init__(self, ports=farm_ports, baud_rate=baud_rate, max_failures=farm_max_failures,
+                 reconnect_delay=farm_reconnect_delay, connect=establish_printer_connection, load_bed=None):
+        self.ports = list(ports)
+        self.baud_rate = baud_rate
+        self.max_failures = max_failures
+        self.reconnect_delay = reconnect_delay
+        # 'connect(port, baud_rate)' returns a PrinterLink (or None if it couldn't connect)
+        self.connect = connect
+        # called as 'load_bed(port, group)' before a printer starts a group, and returns once the bed is
+        # ready (see 'prompt_load_bed'). None starts every group straight away, on whatever is on the
+        # bed, so it's only for virtual printers
+        self.load_bed = load_bed
+
+        self.status = {port: PrinterStatus(port) for port in self.ports}
+        self.lock = threading.Lock()
+
+        self.groups = []
+        self.pending = queue.Queue()
+        self.printed_by = {}            # group -> port it was printed on
+        self.num_left = 0
+
+    def run(self, groups, report_every=None):
+        """Print every unit group (each one's lines in the order they're drawn, see
+        'get_raw_converted_total_lines') across the printers. Progress is printed every 'report_every'
+        seconds if given. Returns the groups that couldn't be printed (if every printer gave up)"""
+        self.groups = list(groups)
+        self.printed_by = {}
+        self.num_left = len(self.groups)
+        for group_idx in range(len(self.groups)):
+            self.pending.put(group_idx)
+
+        workers = [threading.Thread(target=self._worker, args=(port,), daemon=True) for port in self.ports]
+        for worker in workers:
+            worker.start()
+
+        last_report = time.perf_counter()
+        while any(worker.is_alive() for worker in workers):
+            time.sleep(0.1)
+            if report_every is not None and time.perf_counter() - last_report >= report_every:
+                print(self.progress_text())
+                last_report = time.perf_counter()
+
+        return [group_idx for group_idx in range(len(self.groups)) if group_idx not in self.printed_by]
+
+    def progress_text(self):
+        """One line per printer, plus how many groups are left"""
+        with self.lock:
+            lines = [str(status) for status in self.status.values()]
+            lines.append(f"{len(self.groups) - self.num_left}/{len(self.groups)} groups printed")
+        return "\n".join(lines)
+
+    ################## WORKER THREADS
+
+    def _worker(self, port):
+        """Connect to one printer and print groups from the queue until none are left"""
+        status = self.status[port]
+        link = None
+
+        while self.num_left > 0:
+            if link is None:
+                status.state = "connecting"
+                link = self._open(port)
+                if link is None:
+                    if not self._failed(status, None, "couldn't connect"):
+                        break
+                    continue
+                status.state = "idle"
+
+            try:
+                group_idx = self.pending.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            if self._print_group(link, status, group_idx):
+                continue
+
+            # the group goes back for any printer, and this one starts over with a new connection
+            self.pending.put(group_idx)
+            self._close(link)
+            link = None
+            if not self._failed(status, group_idx, status.last_error):
+                break
+
+        if link is not None:
+            self._close(link)
+        if status.state != "gave up":
+            status.state = "finished"
+
+    def _open(self, port):
+        """Connect to a printer and orient its pen. Returns None if it couldn't"""
+        link = self.connect(port, self.baud_rate)
+        if link is None:
+            return None
+        try:
+            prepare_print(link)
+        except (serial.SerialException, OSError) as e:
+            print(f"[{port}] Lost connection while preparing the print: {e}")
+            self._close(link)
+            return None
+        return link
+
+    def _close(self, link):
+        try:
+            link.close()
+        except (serial.SerialException, OSError):
+            pass
+
+    def _print_group(self, link, status, group_idx):
+        """Print one group. Returns False if the printer dropped out or lines were lost"""
+        if self.load_bed is not None:
+            with self.lock:
+                status.state = "loading"
+                status.group = group_idx
+            self.load_bed(status.port, group_idx)
+
+        # (made again on every try, since a group can be printed more than once)
+        gcode = list(generate_gcode(self.groups[group_idx], group=group_idx))
+        with self.lock:
+            status.state = "printing"
+            status.group = group_idx
+            status.commands_sent = 0
+            status.commands_total = len(gcode)
+
+        def counted(commands):
+            for cmd in commands:
+                status.commands_sent += 1
+                yield cmd
+
+        start = time.perf_counter()
+        print(f"[{status.port}] Printing group {group_idx + 1}/{len(self.groups)}")
+        try:
+            all_ok = print_unit_group(link, counted(gcode))
+        except (serial.SerialException, OSError) as e:
+            status.last_error = str(e)
+            return False
+        if not all_ok:
+            status.last_error = "lines weren't acknowledged"
+            return False
+
+        seconds = time.perf_counter() - start
+        with self.lock:
+            self.printed_by[group_idx] = status.port
+            self.num_left -= 1
+            status.state = "idle"
+            status.group = None
+            status.groups_done += 1
+            status.failures_in_a_row = 0
+            status.busy_seconds += seconds
+        print(f"[{status.port}] Finished group {group_idx + 1} in {seconds:.1f}s")
+        return True
+
+    def _failed(self, status, group_idx, error):
+        """Count a failure. Returns False if the printer should be given up on"""
+        with self.lock:
+            status.failures += 1
+            status.failures_in_a_row += 1
+            status.last_error = error
+            status.group = None
+            give_up = status.failures_in_a_row >= self.max_failures
+            status.state = "gave up" if give_up else "reconnecting"
+
+        requeued = "" if group_idx is None else f" (group {group_idx + 1} is back in the queue)"
+        if give_up:
+            print(f"[{status.port}] Giving up after {status.failures_in_a_row} failures: {error}{requeued}")
+            return False
+        print(f"[{status.port}] {error}, reconnecting in {self.reconnect_delay}s{requeued}")
+        time.sleep(self.reconnect_delay)
+        return True
+
+def prompt_load_bed(unit_table=None):
+    """Return a 'load_bed' that asks the operator to put fresh notes on a printer's bed and waits until
+    they confirm. Only one printer asks at a time (the others keep printing meanwhile). With a
+    'unit_table' (see 'group_unit_indices') the notes that go on the bed are listed too"""
+    # (its own lock, not the farm's: holding that while waiting on the operator would stall every printer)
+    lock = threading.Lock()
+
+    def load_bed(port, group_idx):
+        with lock:
+            print(f"\n[{port}] Next up: group {group_idx + 1}. Clear the bed (including any half drawn notes) "
+                  f"and put on fresh notes" + (":" if unit_table is not None else "."))
+            if unit_table is not None:
+                # (numbered and laid out like in 'Main.py')
+                for row in unit_table[group_idx].reshape(bed_units_y, bed_units_x):
+                    print("    " + " ".join(f"{unit + 1:>3}" if unit >= 0 else "  -" for unit in row))
+            while input(f"[{port}] Type \"ready\" once the bed is loaded: ").strip().lower() != "ready":
+                pass
+    return load_bed
+
+if __name__ == '__main__':
+    import sys
+    from Hatch_Cache import cached_hatching_set
+    from Unit_Reorderer import reorder_units_into_groups, get_raw_converted_total_lines, group_unit_indices
+
+    ports = sys.argv[1:] or farm_ports
+    brightness_arrays, total_lines_set = cached_hatching_set(show_image=False)
+    groups = get_raw_converted_total_lines(reorder_units_into_groups(total_lines_set))
+
+    farm = PrinterFarm(ports)
+    farm.load_bed = prompt_load_bed(group_unit_indices())
+    start = time.perf_counter()
+    unprinted = farm.run(groups, report_every=30)
+    print(farm.progress_text())
+    print(f"Printed {len(groups) - len(unprinted)}/{len(groups)} groups on {len(ports)} printers "
+          f"in {time.perf_counter() - start:.1f}s")
+    if unprinted:
+        print(f"Not printed (every printer gave up): groups {', '.join(str(i + 1) for i in unprinted)}")
+        sys.exit(1)
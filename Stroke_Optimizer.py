@@ -0,0 +1,193 @@
+"""
+#############################################################
+SUMMARY: Every hatch line is drawn with the pen down, but the
+pen also has to travel (lifted) from the end of one line to
+the start of the next. This script reorders the lines of a
+unit group (and flips lines around when it's cheaper to draw
+them backwards) to cut down on that pen-up travel:
+1. Serpentine rows (left to right, then right to left, ...)
+2. Nearest neighbour (always go to the closest line end next)
+3. 2-opt (reverse runs of lines while it shortens the path)
+Before that, lines on the same row that touch (or nearly touch)
+are stitched into one, e.g. where a dark band crosses the seam
+between two units. Every stitch saves a lift, travel and drop.
+All distances are worked out on arrays of line endpoints.
+#############################################################
+"""
+
+from Univ_Settings import *
+
+from Line_Set import LINE_DTYPE
+import numpy as np
+
+STROKE_ORDERS = ("raster", "serpentine", "nearest", "2opt")
+
+def _as_array(lines):
+    """Return lines as an (n, 4) float array of [x1, y1, x2, y2]"""
+    return np.asarray(lines, dtype=np.float64).reshape(-1, 4)
+
+def _flip(lines_array, flip_mask):
+    """Swap the start and end of every line where 'flip_mask' is set"""
+    flipped = lines_array.copy()
+    flipped[flip_mask] = lines_array[flip_mask][:, [2, 3, 0, 1]]
+    return flipped
+
+def _back_to_lines(lines_array):
+    # (the distances are worked out in floats so they can't overflow the compact line coordinates)
+    return lines_array.astype(LINE_DTYPE)
+
+def pen_up_travel(lines, start=None):
+    """Return the total distance travelled with the pen up to draw 'lines' in order (from 'start' if given)"""
+    lines_array = _as_array(lines)
+    if len(lines_array) == 0:
+        return 0.0
+    ends = lines_array[:-1, 2:]
+    starts = lines_array[1:, :2]
+    travel = np.hypot(*(starts - ends).T).sum()
+    if start is not None:
+        travel += np.hypot(*(lines_array[0, :2] - np.asarray(start, dtype=np.float64)))
+    return float(travel)
+
+def serpentine_order(lines):
+    """Sort lines into rows drawn alternately left to right and right to left"""
+    lines_array = _as_array(lines)
+    if len(lines_array) == 0:
+        return lines_array
+
+    rows, row_idx = np.unique(lines_array[:, 1], return_inverse=True)
+    backwards = (row_idx % 2 == 1)
+    left_x = np.minimum(lines_array[:, 0], lines_array[:, 2])
+
+    # sort by row, then by x (descending on backwards rows)
+    order = np.lexsort((np.where(backwards, -left_x, left_x), row_idx))
+    lines_array = lines_array[order]
+    backwards = backwards[order]
+
+    # every line points the way its row is drawn
+    points_left = lines_array[:, 2] < lines_array[:, 0]
+    return _flip(lines_array, points_left != backwards)
+
+def nearest_neighbour_order(lines, start=None):
+    """Always draw the line with the closest end next (flipping it if its far end is closer)"""
+    lines_array = _as_array(lines)
+    num_lines = len(lines_array)
+    if num_lines == 0:
+        return lines_array
+
+    starts = lines_array[:, :2]
+    ends = lines_array[:, 2:]
+    pos = starts[0] if start is None else np.asarray(start, dtype=np.float64)
+
+    ordered = np.empty_like(lines_array)
+    remaining = np.ones(num_lines, dtype=bool)
+    for i in range(num_lines):
+        to_start = np.hypot(*(starts - pos).T)
+        to_end = np.hypot(*(ends - pos).T)
+        to_start[~remaining] = np.inf
+        to_end[~remaining] = np.inf
+
+        nearest_start = np.argmin(to_start)
+        nearest_end = np.argmin(to_end)
+        if to_end[nearest_end] < to_start[nearest_start]:
+            ordered[i] = lines_array[nearest_end, [2, 3, 0, 1]]
+            remaining[nearest_end] = False
+        else:
+            ordered[i] = lines_array[nearest_start]
+            remaining[nearest_start] = False
+        pos = ordered[i, 2:]
+
+    return ordered
+
+def two_opt(lines, start=None, max_passes=stroke_2opt_passes, window=stroke_2opt_window):
+    """Reverse runs of lines (drawing each one backwards) while it shortens the pen-up travel.
+    Only runs of up to 'window' lines are tried so big unit groups stay quick."""
+    lines_array = _as_array(lines).copy()
+    num_lines = len(lines_array)
+    if num_lines < 2:
+        return lines_array
+    start = lines_array[0, :2].copy() if start is None else np.asarray(start, dtype=np.float64)
+
+    for _ in range(max_passes):
+        improved = False
+        for i in range(num_lines):
+            last = min(num_lines, i + window)
+            # the pen position before line i and the lines that could end the reversed run
+            before = start if i == 0 else lines_array[i - 1, 2:]
+            run_starts = lines_array[i, :2]
+            run_ends = lines_array[i:last, 2:]
+            after = lines_array[i + 1:last + 1, :2]
+
+            # reversing lines i..j joins 'before' to the end of line j and the start of line i to 'after'
+            removed = np.hypot(*(run_starts - before)) + np.zeros(last - i)
+            added = np.hypot(*(run_ends - before).T)
+            removed[:len(after)] += np.hypot(*(after - run_ends[:len(after)]).T)
+            added[:len(after)] += np.hypot(*(after - run_starts).T)
+
+            delta = added - removed
+            j = np.argmin(delta)
+            if delta[j] < -1e-9:
+                lines_array[i:i + j + 1] = lines_array[i:i + j + 1][::-1][:, [2, 3, 0, 1]]
+                improved = True
+        if not improved:
+            break
+
+    return lines_array
+
+def stitch_strokes(lines, max_gap=stitch_max_gap):
+    """Join horizontal lines on the same row that are at most 'max_gap' apart (across unit seams
+    too, so run this on the group's offset lines). Returns (stitched lines, number of lines removed,
+    i.e. Z lift/drop cycles saved). Lines that aren't horizontal are left as they are."""
+    lines_array = _as_array(lines)
+    horizontal = lines_array[:, 1] == lines_array[:, 3]
+    others = lines_array[~horizontal]
+    lines_array = lines_array[horizontal]
+    if len(lines_array) < 2:
+        return lines, 0
+
+    y = lines_array[:, 1]
+    left = np.minimum(lines_array[:, 0], lines_array[:, 2])
+    right = np.maximum(lines_array[:, 0], lines_array[:, 2])
+    order = np.lexsort((left, y))
+    y, left, right = y[order], left[order], right[order]
+
+    # furthest right any line reaches so far in each row (rows are sorted, so offsetting each
+    # row above the last keeps the running max from carrying over between rows)
+    row_offset = (right.max() - right.min() + 1) * np.unique(y, return_inverse=True)[1]
+    reach = np.maximum.accumulate(right + row_offset) - row_offset
+
+    # a new stroke starts on every new row and wherever the gap to the stroke so far is too big
+    new_stroke = np.ones(len(y), dtype=bool)
+    new_stroke[1:] = (y[1:] != y[:-1]) | (left[1:] - reach[:-1] > max_gap)
+    stroke_starts = np.flatnonzero(new_stroke)
+
+    stitched = np.stack([
+        left[stroke_starts],
+        y[stroke_starts],
+        np.maximum.reduceat(right, stroke_starts),
+        y[stroke_starts],
+    ], axis=1)
+
+    num_removed = len(lines_array) - len(stitched)
+    return _back_to_lines(np.concatenate([stitched, others])), num_removed
+
+def order_strokes(lines, method=stroke_order, start=None):
+    """Reorder a unit group's lines to cut pen-up travel.
+    Returns (ordered lines, pen-up travel before, pen-up travel after)"""
+    if method not in STROKE_ORDERS:
+        raise ValueError(f"Unknown stroke order '{method}' (expected one of {STROKE_ORDERS})")
+
+    travel_before = pen_up_travel(lines, start)
+    if method == "raster" or len(lines) < 2:
+        return lines, travel_before, travel_before
+
+    ordered = serpentine_order(lines)
+    if method in ("nearest", "2opt"):
+        ordered = nearest_neighbour_order(ordered, ordered[0, :2] if start is None else start)
+    if method == "2opt":
+        ordered = two_opt(ordered, start)
+
+    travel_after = pen_up_travel(ordered, start)
+    # never hand back something worse than what came in
+    if travel_after > travel_before:
+        return lines, travel_before, travel_before
+    return _back_to_lines(ordered), travel_before, travel_after
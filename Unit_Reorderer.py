@@ -1,66 +1,131 @@
 """
 #############################################################
-SUMMARY: The printing gantry can cover a space of 4 units in
-a 2x2 area, meaning the units need to be rearranged before
-converted into g-code. This script will take the first 4 units
-of each list and rearrange them into this 2x2 pattern and keep
-each pattern separate for printing. This new list is passed
+SUMMARY: The printing gantry can cover a space of
+'bed_units_x' x 'bed_units_y' units (2x2 on the original
+printer), meaning the units need to be rearranged before
+converted into g-code. This script splits the mural into
+patches of that size (so every bed load is a real block of
+neighbouring notes, laid out on the bed the way they sit in
+the mural), moves each unit to its place on the bed, and keeps
+each bed load separate for printing. This new list is passed
 onto the 'G-Code Converter.'
 #############################################################
 """
 
 from Univ_Settings import *
+from Stroke_Optimizer import order_strokes, stitch_strokes
+from Line_Set import LineSet
+from Metrics import metrics
+import numpy as np
 
+################### BED LAYOUT
+
+def group_unit_indices(dimensions=(units_wide, units_high), layout=(bed_units_x, bed_units_y)):
+    """Return a (number of groups, units per group) table of which mural unit goes in each spot on the
+    bed for every group (-1 where a patch hangs off the edge of the mural). Groups go top left to bottom
+    right over the mural, and the spots of a group go top left to bottom right over the bed"""
+    (mural_wide, mural_high), (bed_wide, bed_high) = dimensions, layout
+    groups_wide = -(-mural_wide // bed_wide)
+    groups_high = -(-mural_high // bed_high)
+
+    # mural row and column of every spot of every group, shaped (groups_high, groups_wide, bed_high, bed_wide)
+    rows = (np.arange(groups_high)[:, None, None, None] * bed_high + np.arange(bed_high)[None, None, :, None])
+    cols = (np.arange(groups_wide)[None, :, None, None] * bed_wide + np.arange(bed_wide)[None, None, None, :])
+    rows, cols = np.broadcast_arrays(rows, cols)
+
+    unit_indices = np.where((rows < mural_high) & (cols < mural_wide), rows * mural_wide + cols, -1)
+    return unit_indices.reshape(groups_high * groups_wide, bed_high * bed_wide)
+
+def locate_unit(unit_idx, dimensions=(units_wide, units_high), layout=(bed_units_x, bed_units_y)):
+    """Return (group, spot on the bed) of a mural unit (0 is the top left note)"""
+    group, spot = np.argwhere(group_unit_indices(dimensions, layout) == unit_idx)[0]
+    return int(group), int(spot)
+
+def place_units_on_bed(line_set, unit_table, layout=(bed_units_x, bed_units_y)):
+    """Put the units of 'unit_table' (see 'group_unit_indices') into a LineSet per group, with every
+    unit moved to its spot on the bed"""
+    bed_wide = layout[0]
+    units_per_group = unit_table.shape[1]
+
+    # spots with no unit get an empty unit tacked onto the end
+    line_set = line_set.padded(len(line_set) + 1)
+    grouped = line_set.take(np.where(unit_table < 0, len(line_set) - 1, unit_table))
+
+    # add offsets for printing to every unit at once
+    spots = np.arange(len(grouped)) % units_per_group
+    grouped = grouped.translated((spots % bed_wide) * pixels_per_unit_x, (spots // bed_wide) * pixels_per_unit_y)
+
+    return [grouped[i * units_per_group:(i + 1) * units_per_group] for i in range(len(unit_table))]
+
+@metrics.timed("reordering")
+def reorder_units_into_groups(total_lines_set, dimensions=(units_wide, units_high),
+                              layout=(bed_units_x, bed_units_y)):
+    """Take the lines of every unit (a LineSet, or the old nested lists) and return them split into
+    bed loads of 'layout' units (a LineSet per group), with every unit moved to its spot on the bed.
+    The lines passed in are left as they are"""
+    line_set = LineSet.coerce(total_lines_set)
+    if len(line_set) == 0:
+        return []
+    return place_units_on_bed(line_set, group_unit_indices(dimensions, layout), layout)
+
+@metrics.timed("reordering")
 def reorder_units_groups_of_four(total_lines_set, group_div=4):
-    """Take list and return it converted into units by groups of 4"""
-    converted_total_lines = []
-
-    temp_unit_group = []
-    for i, unit in enumerate(total_lines_set):
-        if i != 0 and i % group_div == 0:
-            converted_total_lines.append(temp_unit_group)
-            temp_unit_group = [unit]        # reset temporary list
-        else:
-            temp_unit_group.append(unit)
-
-        # edge case - add extra empty units to fill in set
-        # print(i, len(total_lines_set)-1)
-        if i == len(total_lines_set) - 1:
-            for empty_space in range(group_div - len(temp_unit_group)):
-                temp_unit_group.append([])
-            converted_total_lines.append(temp_unit_group)
-
-    for unit_group in converted_total_lines:
-        # add offsets for printing (2x2 orientation)
-        #print(len(unit_group))
-        _add_offset(unit_group[1], pixels_per_unit_x, 0)        # upper right corner
-        _add_offset(unit_group[2], 0, pixels_per_unit_y)        # bottom left corner
-        _add_offset(unit_group[3], pixels_per_unit_x, pixels_per_unit_y)    # bottom right corner
-
-    return converted_total_lines
-
-def get_raw_converted_total_lines(new_converted_total_lines):
+    """The original grouping: every 'group_div' units in list order (not by their place in the mural),
+    laid out 2 wide on the bed"""
+    line_set = LineSet.coerce(total_lines_set)
+    if len(line_set) == 0:
+        return []
+
+    # edge case - add extra empty units to fill in the last set
+    num_groups = -(-len(line_set) // group_div)
+    unit_table = np.arange(num_groups * group_div).reshape(num_groups, group_div)
+    unit_table[unit_table >= len(line_set)] = -1
+    return place_units_on_bed(line_set, unit_table, (2, -(-group_div // 2)))
+
+################### LINE ORDER
+
+def order_group_lines(unit_group, stroke_order=stroke_order, stitch=use_stroke_stitching, max_gap=stitch_max_gap):
+    """Put one unit group's lines into a single (n, 4) array in the order they're drawn.
+    Returns (lines, lines removed by stitching, pen-up travel before ordering, pen-up travel after)"""
+    # empty out the lines into the unit group
+    # (a group's units are already one after another in its array)
+    new_unit_group = LineSet.coerce(unit_group).lines
+    num_stitched = 0
+    # join lines that touch (across unit seams too, since the offsets are already added)
+    if stitch:
+        new_unit_group, num_stitched = stitch_strokes(new_unit_group, max_gap)
+    # reorder whole group top left to bottom right
+    # (by y, then by left x. lexsort keeps lines that tie in the order they were in)
+    new_unit_group = new_unit_group[np.lexsort((np.minimum(new_unit_group[:, 0], new_unit_group[:, 2]),
+                                                new_unit_group[:, 1]))]
+    new_unit_group, travel_before, travel_after = order_strokes(new_unit_group, stroke_order)
+    return new_unit_group, num_stitched, travel_before, travel_after
+
+@metrics.timed("stroke_ordering")
+def get_raw_converted_total_lines(new_converted_total_lines, stroke_order=stroke_order,
+                                  stitch=use_stroke_stitching, max_gap=stitch_max_gap):
     """The converted total lines set originally comes grouped by 4, and this func puts those groups
-    in one single long list of lines ordered top left to bottom right (for g-code conversion ease)"""
+    in one single long (n, 4) array of lines ordered top left to bottom right (for g-code conversion ease).
+    Touching lines are stitched together (if 'stitch') and the lines are then reordered with
+    'stroke_order' to cut down pen-up travel (see 'Stroke_Optimizer.py')"""
     raw_converted_total_lines = []
+    total_travel_before = 0
+    total_travel_after = 0
+    total_stitched = 0
 
-    # empty out the lines into each unit group and reorder them top left to bottom right using 'sorted()'
-    for unit_group in new_converted_total_lines:
-        new_unit_group = []
-        for unit in unit_group:
-            for line in unit:
-                new_unit_group.append(line)
-        # reorder whole group
-        new_unit_group = sorted(new_unit_group, key=lambda line: (line[1], min(line[0], line[2])))
+    for i, unit_group in enumerate(new_converted_total_lines):
+        new_unit_group, num_stitched, travel_before, travel_after = order_group_lines(unit_group, stroke_order,
+                                                                                     stitch, max_gap)
+        total_stitched += num_stitched
+        total_travel_before += travel_before
+        total_travel_after += travel_after
+        metrics.count(i, "lines", len(new_unit_group))
         raw_converted_total_lines.append(new_unit_group)
 
-    return raw_converted_total_lines
+    if stitch:
+        print(f"Stroke stitching: joined {total_stitched} lines ({total_stitched} fewer Z lift/drop cycles)")
+    if stroke_order != "raster" and total_travel_before:
+        print(f"Stroke ordering ({stroke_order}): pen-up travel {total_travel_before:.0f}mm -> "
+              f"{total_travel_after:.0f}mm ({100 * (1 - total_travel_after / total_travel_before):.0f}% less)")
 
-def _add_offset(unit_line_set, x_offset, y_offset):
-    """Add offset to unit_line_set depending on corner of the print"""
-    # line: [x1, y1, x2, y2]
-    for line in unit_line_set:
-        line[0] += x_offset
-        line[2] += x_offset
-        line[1] += y_offset
-        line[3] += y_offset
\ No newline at end of file
+    return raw_converted_total_lines
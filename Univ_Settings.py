@@ -88,11 +88,68 @@ pixels_of_deadspace = 5
 preview_image_dim = (1000, 800)
 preview_image_cap = "Linear Printer Preview"
 preview_line_color = (0, 0, 0)
+preview_background_color = (255, 255, 255)
+
+# how much UP / DOWN changes white_cap in the tuner (Hatch_Tuner.py)
+tuner_white_cap_step = 5
+
+# hatching engine: "python" (pixel by pixel) or "numpy" (whole stack of units at once, same output),
+# or "crosshatch" (layers of long lines at 0/45/90/135 degrees instead of packed rows)
+hatch_engine = "numpy"
+
+# cross-hatching: pixels between the lines of a layer, gaps (in pixels) along a line that are drawn
+# straight through, and the shortest stroke worth drawing
+crosshatch_spacing = 3
+crosshatch_max_gap = 1
+crosshatch_min_length = 2
+
+# parallel hatching: worker processes (None for one per core, 1 to always hatch serially),
+# units sent to a worker at a time, and the fewest units worth starting a process pool for with
+# each engine. Only the pixel by pixel engine is slow enough per unit for a pool to pay off: the
+# array engines hatch hundreds of units in less time than it takes to start the workers (more so
+# on Windows, where every worker imports numpy again), so engines not listed always hatch serially
+hatch_workers = None
+hatch_chunk_size = 8
+hatch_parallel_min_units = {"python": 24}
+
+# load big images at (close to) the size needed instead of decoding and resizing every pixel:
+# only the part of the image that's used is resampled, JPEGs are decoded at 1/2, 1/4 or 1/8 scale,
+# and images are shrunk by whole factors first, always keeping at least 'image_prescale_margin'
+# times the final size for the LANCZOS resize. Images that would need more than
+# 'image_load_max_bytes' of memory to decode aren't loaded
+fast_image_loading = True
+image_prescale_margin = 2
+image_load_max_bytes = 512 * 1024 * 1024
+
+# on-disk cache of hatching results (keyed by image file and settings), kept under a size limit
+use_hatch_cache = True
+hatch_cache_dir = "hatch_cache"
+hatch_cache_max_bytes = 256 * 1024 * 1024
 
 # number of pixels (lines) that can fit on a sticky-note
 pixels_per_unit_x = 76
 pixels_per_unit_y = 76
 
+# area the gantry can draw in (in mm, which is the same as pixels). Every bed load (unit group)
+# is as many notes as fit in it, taken from one 'bed_units_x' x 'bed_units_y' patch of the mural.
+# set 'bed_units_x' / 'bed_units_y' directly to use less of the bed
+gantry_reach_x = 152
+gantry_reach_y = 152
+bed_units_x = gantry_reach_x // pixels_per_unit_x
+bed_units_y = gantry_reach_y // pixels_per_unit_y
+
+# join lines on the same row of a unit group at most 'stitch_max_gap' apart into one line.
+# (lines end on the first blank pixel after them, so lines either side of a unit seam are 1 apart)
+use_stroke_stitching = True
+stitch_max_gap = 1
+
+# order lines are drawn in within a unit group: "raster" (top to bottom, left to right),
+# "serpentine", "nearest" (nearest neighbour) or "2opt" (nearest neighbour then 2-opt).
+# 2-opt makes up to 'stroke_2opt_passes' passes, reversing runs of up to 'stroke_2opt_window' lines
+stroke_order = "2opt"
+stroke_2opt_passes = 3
+stroke_2opt_window = 400
+
 # printing vars
 z_draw_level = 97.6
 z_lift_level = 99.6
@@ -102,6 +159,65 @@ z_print_start_offset = 120
 print_speed = 2000
 travel_speed = 4000
 
+# leave out g-code words that wouldn't change anything (and travel to where the pen already is),
+# and optionally lift the pen during the travel to the next line instead of before it
+compact_gcode = True
+merge_lift_travel = False
+
+# print time simulator (per axis X, Y, Z): max speeds (mm/s), accelerations (mm/s^2),
+# the firmware's junction deviation (mm) and time for the pen to settle after a Z move (s)
+sim_max_feedrates = (300, 300, 3)
+sim_max_accelerations = (500, 500, 100)
+sim_junction_deviation = 0.013
+sim_z_settle_time = 0.0
+
+# record per-stage timings, per-group counters and serial latency, saved per job to 'metrics_dir'
+# as "json" or "csv"
+collect_metrics = False
+metrics_dir = "metrics"
+metrics_format = "json"
+
+# pipelined printing (Print_Pipeline.py): work out one unit group at a time in the background while
+# earlier groups print, so the first group starts as soon as it's ready. At most
+# 'pipeline_prefetch_groups' finished groups wait to be printed
+use_print_pipeline = False
+pipeline_prefetch_groups = 2
+
+# folder exported g-code jobs are saved to
+gcode_export_dir = "gcode_jobs"
+
 # printer settings
 baud_rate = 256000
-printer_port = "COM3"
\ No newline at end of file
+printer_port = "COM3"
+
+# streaming sender: keep several commands in flight instead of waiting for each 'ok'
+# (False sends in lockstep). Sized to the firmware's serial receive buffer (RX_BUFFER_SIZE,
+# minus one byte) and its command queue (BUFSIZE)
+use_streaming_sender = True
+printer_rx_buffer_size = 127
+max_commands_in_flight = 4
+
+# frame commands as 'N<line> <cmd>*<checksum>' so bad lines get re-sent, keeping the
+# last 'resend_history_size' lines around to re-send from
+use_line_numbers = True
+resend_history_size = 256
+
+# printer farm (Printer_Farm.py): unit groups are handed to whichever of these printers is free.
+# A printer that drops out is reconnected after 'farm_reconnect_delay' seconds (its group goes
+# back in the queue for any printer), and is given up on after 'farm_max_failures' failures in a row
+farm_ports = ["COM3", "COM4"]
+farm_max_failures = 3
+farm_reconnect_delay = 5
+
+# virtual printer (Virtual_Printer.py): a stand-in for the printer's firmware to test and time the
+# sender without hardware. It asks for 'virtual_resend_rate' of lines again and sends 'busy' before
+# 'virtual_busy_rate' of commands (both at random), holds 'virtual_planner_size' moves and
+# 'virtual_rx_buffer_size' bytes of unread lines, and sends 'busy' every 'virtual_busy_interval'
+# seconds while it can't take a command. Moves take 'virtual_time_scale' times as long as on the
+# real printer (0 finishes them instantly)
+virtual_resend_rate = 0.0
+virtual_busy_rate = 0.0
+virtual_planner_size = 16
+virtual_rx_buffer_size = 128
+virtual_busy_interval = 2
+virtual_time_scale = 0.0
\ No newline at end of file
@@ -0,0 +1,462 @@
+"""
+#############################################################
+SUMMARY: A stand-in for the printer's Marlin firmware, so the
+sender in 'GCode_Controller.py' can be tested and timed on any
+Linux machine with no printer attached. It shows up as a
+serial port (a pty, e.g. '/dev/pts/5') or a pyserial URL
+('socket://localhost:5000'), and behaves like the firmware
+as far as the sender can tell:
+1. Line numbers and checksums are checked, and a bad or out
+   of order line is answered with 'Resend: <line>' then 'ok'
+2. Lines arrive through a receive buffer of
+   'virtual_rx_buffer_size' bytes (lines that overflow it get
+   corrupted) at the speed of the baud rate
+3. Moves go into a planner of 'virtual_planner_size' moves,
+   and 'ok' is only sent once a move is in the planner, so a
+   full planner holds the sender back ('busy: processing' is
+   sent while it waits)
+4. Moves take their distance / feedrate (no acceleration)
+   times 'virtual_time_scale' (0 finishes them instantly)
+5. Resends and 'busy' can be made to happen at random
+   ('virtual_resend_rate', 'virtual_busy_rate')
+Every move it makes is logged, so a print can be checked
+against the g-code that was sent.
+
+USAGE:
+    python Virtual_Printer.py [--socket 5000]     (serves a virtual printer until Ctrl-C)
+    python Virtual_Printer.py --benchmark         (times the sender against a virtual printer)
+    (both take [--resend-rate 0.01] [--busy-rate 0.01] [--time-scale 1] [--log moves.log])
+#############################################################
+"""
+
+from Univ_Settings import *
+
+from functools import reduce
+from operator import xor
+import numpy as np
+import argparse
+import math
+import os
+import queue
+import re
+import select
+import socket
+import threading
+import time
+import tty
+
+# how long the firmware takes to home (seconds, before 'time_scale')
+HOMING_SECONDS = 5.0
+# feedrate (mm/min) until a command sets one
+DEFAULT_FEEDRATE = 3000
+
+_NUMBERED_LINE = re.compile(rb'N(-?\d+)\s*(.*)')
+_WORD = re.compile(rb'([A-Z])(-?[\d.]+)')
+
+class VirtualPrinter:
+    """A software Marlin printer. Connect to it through 'open_pty' or 'serve'"""
+
+    def __init__(self, resend_rate=virtual_resend_rate, busy_rate=virtual_busy_rate,
+                 planner_size=virtual_planner_size, rx_buffer_size=virtual_rx_buffer_size,
+                 time_scale=virtual_time_scale, baud=baud_rate, busy_interval=virtual_busy_interval,
+                 log_path=None, seed=None):
+        self.resend_rate = resend_rate
+        self.busy_rate = busy_rate
+        self.planner_size = planner_size
+        self.rx_buffer_size = rx_buffer_size
+        self.time_scale = time_scale
+        self.baud = baud
+        self.busy_interval = busy_interval
+        self.log_path = log_path
+        self.rng = np.random.default_rng(seed)
+
+        # every move made: (command, x, y, z, feedrate, seconds it took before 'time_scale')
+        self.moves = []
+        self.stats = dict.fromkeys(("lines", "commands", "moves", "resends", "busy", "overflows"), 0)
+        self.stats["motion_seconds"] = 0.0
+
+        self.running = True
+        self.threads = []
+        self.reset()
+
+    def reset(self):
+        """Power on state (the board resets whenever a connection is opened)"""
+        self.last_line = 0
+        self.position = {b'X': 0.0, b'Y': 0.0, b'Z': 0.0}
+        self.feedrate = DEFAULT_FEEDRATE
+        self.relative = False
+
+    ################## CONNECTIONS
+
+    def open_pty(self):
+        """Start the printer on a new pty and return the port to connect to (e.g. '/dev/pts/5')"""
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        # (the printer keeps its own end of the port open, so it stays up between connections)
+        self._pty_fds = (master, slave)
+
+        def read():
+            if not select.select([master], [], [], 0.1)[0]:
+                return None
+            return os.read(master, 4096)
+
+        def write(data):
+            os.write(master, data)
+
+        self._start(self._session, read, write)
+        return os.ttyname(slave)
+
+    def serve(self, port=0):
+        """Start the printer on a local TCP port and return its pyserial URL (each new connection
+        resets the printer, like opening the real printer's port does)"""
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("127.0.0.1", port))
+        server.listen()
+        server.settimeout(0.1)
+        self._server = server
+        self._start(self._accept, server)
+        return f"socket://127.0.0.1:{server.getsockname()[1]}"
+
+    def _accept(self, server):
+        while self.running:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            conn.settimeout(0.1)
+
+            def read():
+                try:
+                    return conn.recv(4096)      # (b'' when the sender hangs up)
+                except socket.timeout:
+                    return None
+
+            self.reset()
+            conn.sendall(b'start\n')
+            self._session(read, conn.sendall)
+            conn.close()
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def close(self):
+        """Stop the printer"""
+        self.running = False
+        for thread in self.threads:
+            thread.join(timeout=2)
+        if hasattr(self, "_server"):
+            self._server.close()
+        if hasattr(self, "_pty_fds"):
+            for fd in self._pty_fds:
+                os.close(fd)
+
+    ################## ONE CONNECTION
+
+    def _session(self, read, write):
+        """Read lines into the receive buffer until the connection closes, while one thread runs the
+        commands (sending the responses) and another carries out the moves in the planner"""
+        rx_lines = queue.Queue()
+        planner = queue.Queue(maxsize=self.planner_size)
+        stopping = threading.Event()
+        # bytes waiting in the receive buffer, and when the last of them will have arrived (at the baud rate)
+        rx = {"bytes": 0, "arrival": 0.0}
+        rx_lock = threading.Lock()
+
+        commands = threading.Thread(target=self._run_commands, args=(rx_lines, rx, rx_lock, planner, write, stopping),
+                                    daemon=True)
+        motion = threading.Thread(target=self._run_motion, args=(planner, stopping), daemon=True)
+        commands.start()
+        motion.start()
+
+        partial = b''
+        while self.running:
+            try:
+                data = read()
+            except OSError:
+                break
+            if data is None:
+                continue
+            if not data:
+                break
+            partial += data
+            *lines, partial = partial.split(b'\n')
+            for line in lines:
+                num_bytes = len(line) + 1
+                with rx_lock:
+                    if rx["bytes"] + num_bytes > self.rx_buffer_size:
+                        # the buffer ran over and bytes were lost, so the line won't pass its checksum
+                        self.stats["overflows"] += 1
+                        line = line[:max(self.rx_buffer_size - rx["bytes"] - 1, 0)]
+                    rx["bytes"] += num_bytes
+                    if self.baud:
+                        rx["arrival"] = max(rx["arrival"], time.perf_counter()) + num_bytes * 10 / self.baud
+                    rx_lines.put((line, num_bytes, rx["arrival"]))
+
+        stopping.set()
+        commands.join(timeout=2)
+        motion.join(timeout=2)
+
+    def _run_commands(self, rx_lines, rx, rx_lock, planner, write, stopping):
+        """Take lines out of the receive buffer one at a time and run them"""
+        while not stopping.is_set():
+            try:
+                line, num_bytes, arrival = rx_lines.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            delay = arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            with rx_lock:
+                rx["bytes"] -= num_bytes
+
+            self.stats["lines"] += 1
+            for response in self._handle_line(line.strip(), planner, write, stopping):
+                write(response + b'\n')
+
+    def _run_motion(self, planner, stopping):
+        """Carry out the moves in the planner in order"""
+        while not stopping.is_set():
+            try:
+                seconds = planner.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if self.time_scale:
+                time.sleep(seconds * self.time_scale)
+            self.stats["motion_seconds"] += seconds
+            planner.task_done()
+
+    ################## FIRMWARE
+
+    def _handle_line(self, line, planner, write, stopping):
+        """Check and run one line. Returns the responses to send"""
+        line = line.split(b';')[0].strip()
+        if not line:
+            return [b'ok']
+
+        # line number and checksum
+        if line.startswith(b'N'):
+            body, star, checksum = line.partition(b'*')
+            match = _NUMBERED_LINE.match(body)
+            if not match or not star:
+                return self._resend(b'No Checksum with line number')
+            if not checksum.strip().isdigit() or int(checksum) != reduce(xor, body, 0):
+                return self._resend(b'checksum mismatch')
+            line_number, cmd = int(match.group(1)), match.group(2).strip()
+            if cmd.startswith(b'M110'):
+                self.last_line = line_number
+            elif line_number != self.last_line + 1:
+                return self._resend(b'Line Number is not Last Line Number+1')
+            elif self.rng.random() < self.resend_rate:
+                # made-up noise on the line
+                return self._resend(b'checksum mismatch')
+            self.last_line = line_number
+        else:
+            cmd = line
+
+        responses = []
+        if self.rng.random() < self.busy_rate:
+            self.stats["busy"] += 1
+            responses.append(b'echo:busy: processing')
+        self._run_command(cmd, planner, write, stopping)
+        self.stats["commands"] += 1
+        responses.append(b'ok')
+        return responses
+
+    def _resend(self, error):
+        """Ask for the line after the last good one again"""
+        self.stats["resends"] += 1
+        return [b'Error:%s, Last Line: %d' % (error, self.last_line), b'Resend: %d' % (self.last_line + 1), b'ok']
+
+    def _run_command(self, cmd, planner, write, stopping):
+        words = _WORD.findall(cmd.upper())
+        if not words:
+            return
+        code = words[0][0] + words[0][1]
+        params = {letter: float(value) for letter, value in words[1:]}
+
+        if code in (b'G0', b'G1'):
+            if b'F' in params:
+                self.feedrate = params[b'F']
+            target = dict(self.position)
+            for axis in target:
+                if axis in params:
+                    target[axis] = target[axis] + params[axis] if self.relative else params[axis]
+            distance = math.dist(self.position.values(), target.values())
+            seconds = distance / (self.feedrate / 60) if self.feedrate > 0 else 0.0
+            self.position = target
+            self._log_move(code, seconds)
+            self._plan(seconds, planner, write, stopping)
+        elif code == b'G28':
+            # homing waits for the moves before it to finish
+            self._wait_until_idle(planner, write, stopping)
+            for axis in self.position:
+                if axis in params or not params:
+                    self.position[axis] = 0.0
+            self._log_move(code, HOMING_SECONDS)
+            self._plan(HOMING_SECONDS, planner, write, stopping)
+        elif code == b'G90':
+            self.relative = False
+        elif code == b'G91':
+            self.relative = True
+        elif code == b'G92':
+            for axis in self.position:
+                if axis in params:
+                    self.position[axis] = params[axis]
+        elif code == b'M400':
+            self._wait_until_idle(planner, write, stopping)
+        # anything else is accepted and does nothing
+
+    def _plan(self, seconds, planner, write, stopping):
+        """Add a move to the planner, waiting (and telling the host it's busy) while it's full"""
+        while not stopping.is_set():
+            try:
+                planner.put(seconds, timeout=self.busy_interval)
+                return
+            except queue.Full:
+                self.stats["busy"] += 1
+                write(b'echo:busy: processing\n')
+
+    def _wait_until_idle(self, planner, write, stopping):
+        """Wait for every move in the planner to finish"""
+        waited = time.perf_counter()
+        while planner.unfinished_tasks and not stopping.is_set():
+            time.sleep(0.001)
+            if time.perf_counter() - waited > self.busy_interval:
+                self.stats["busy"] += 1
+                write(b'echo:busy: processing\n')
+                waited = time.perf_counter()
+
+    def _log_move(self, code, seconds):
+        move = (code.decode(), self.position[b'X'], self.position[b'Y'], self.position[b'Z'], self.feedrate, seconds)
+        self.moves.append(move)
+        self.stats["moves"] += 1
+        if self.log_path:
+            with open(self.log_path, "a") as log:
+                log.write("%s X%g Y%g Z%g F%g (%.3fs)\n" % move)
+
+################### SENDER BENCHMARK
+
+def gcode_moves(gcode):
+    """The (command, x, y, z) every move in 'gcode' should end at, in order, worked out straight from
+    the commands (to check against the moves a printer logged, see 'made_moves')"""
+    position = {b'X': 0.0, b'Y': 0.0, b'Z': 0.0}
+    relative = False
+    moves = []
+    for cmd in gcode:
+        if isinstance(cmd, str):
+            cmd = cmd.encode('utf-8')
+        words = _WORD.findall(cmd.split(b';')[0].strip().upper())
+        if not words:
+            continue
+        code = words[0][0] + words[0][1]
+        params = {letter: float(value) for letter, value in words[1:]}
+        if code in (b'G0', b'G1'):
+            for axis in position:
+                if axis in params:
+                    position[axis] = position[axis] + params[axis] if relative else params[axis]
+        elif code == b'G28':
+            for axis in position:
+                if axis in params or not params:
+                    position[axis] = 0.0
+        elif code in (b'G90', b'G91'):
+            relative = code == b'G91'
+        elif code == b'G92':
+            position.update((axis, params[axis]) for axis in position if axis in params)
+        if code in (b'G0', b'G1', b'G28'):
+            moves.append((code.decode(), position[b'X'], position[b'Y'], position[b'Z']))
+    return moves
+
+def made_moves(printer):
+    """The (command, x, y, z) of every move a virtual printer made, in order"""
+    return [move[:4] for move in printer.moves]
+
+def sample_gcode(dimensions=(2, 2)):
+    """G-code for the first unit group of a made-up image"""
+    from Benchmark import synthetic_image
+    from Image_Generator import resize_and_crop, tile_units
+    from Hatch_Algorithm import HATCH_ENGINES
+    from Unit_Reorderer import reorder_units_into_groups, order_group_lines
+    from GCode_Controller import generate_gcode
+
+    img = resize_and_crop(synthetic_image("photo", (400, 400)), dimensions, pixels_per_unit_x, pixels_per_unit_y, 0)
+    units = np.ascontiguousarray(tile_units(np.asarray(img), dimensions, pixels_per_unit_x, pixels_per_unit_y, 0)
+                                 ).reshape(-1, pixels_per_unit_y, pixels_per_unit_x)
+    groups = reorder_units_into_groups(HATCH_ENGINES[hatch_engine](units, white_cap), dimensions)
+    return list(generate_gcode(order_group_lines(groups[0])[0]))
+
+def benchmark_sender(gcode, streaming=True, **printer_options):
+    """Send 'gcode' to a new virtual printer (on a pty) and return how fast it went: commands per second,
+    'ok' latency, resends and whether every move arrived exactly once"""
+    from GCode_Controller import establish_printer_connection
+    from Metrics import metrics
+
+    printer = VirtualPrinter(**printer_options)
+    link = establish_printer_connection(printer.open_pty(), baud_rate, settle_time=0)
+    was_enabled = metrics.enabled
+    metrics.enabled = True
+    metrics.reset()
+
+    start = time.perf_counter()
+    if streaming:
+        all_ok = link.stream(gcode)
+    else:
+        all_ok = all([link.send_command(cmd) for cmd in gcode])
+    seconds = time.perf_counter() - start
+
+    link.close()
+    printer.close()
+    num_latencies = sum(metrics.latency_counts)
+    result = {
+        "sender": "streaming" if streaming else "lockstep",
+        "commands": len(gcode),
+        "seconds": seconds,
+        "commands_per_second": len(gcode) / seconds,
+        "mean_latency_ms": 1000 * metrics.latency_total / max(num_latencies, 1),
+        "max_latency_ms": 1000 * metrics.latency_max,
+        "resends": link.num_resends,
+        "timeouts": link.num_timeouts,
+        "busy": printer.stats["busy"],
+        "all_ok": all_ok,
+        # every move sent should have been made exactly once, in order and to the right place
+        "moves_match": made_moves(printer) == gcode_moves(gcode),
+    }
+    metrics.enabled = was_enabled
+    metrics.reset()
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="A virtual Marlin printer for testing the sender without hardware")
+    parser.add_argument("--socket", type=int, help="serve on this TCP port instead of a pty")
+    parser.add_argument("--benchmark", action="store_true", help="time the sender against a virtual printer")
+    parser.add_argument("--resend-rate", type=float, default=virtual_resend_rate)
+    parser.add_argument("--busy-rate", type=float, default=virtual_busy_rate)
+    parser.add_argument("--time-scale", type=float, default=virtual_time_scale,
+                        help="how long moves take compared to the real printer (0 is instant)")
+    parser.add_argument("--log", help="file to log every move to")
+    args = parser.parse_args()
+    options = {"resend_rate": args.resend_rate, "busy_rate": args.busy_rate, "time_scale": args.time_scale,
+               "log_path": args.log}
+
+    if args.benchmark:
+        gcode = sample_gcode()
+        for streaming in (False, True):
+            result = benchmark_sender(gcode, streaming, seed=0, **options)
+            print(f"{result['sender']:>9}: {result['commands']} commands in {result['seconds']:.2f}s "
+                  f"({result['commands_per_second']:.0f}/s), latency {result['mean_latency_ms']:.2f}ms mean "
+                  f"{result['max_latency_ms']:.2f}ms max, {result['resends']} resends, "
+                  f"{'all moves made once' if result['moves_match'] else 'MOVES LOST OR REPEATED'}")
+    else:
+        printer = VirtualPrinter(**options)
+        port = printer.serve(args.socket) if args.socket is not None else printer.open_pty()
+        print(f"Virtual printer on {port} (set 'printer_port' to this, Ctrl-C to stop)")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            printer.close()
+            print(printer.stats)